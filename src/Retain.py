@@ -1,8 +1,8 @@
-import json
 import math
 import os
 import unicodedata
 from typing import Any, Dict, List
+from magatzem_casos import MagatzemCasos, MagatzemCasosSQLite, obrir_magatzem
 
 """
 GESTOR DE LA FASE RETAIN (Aprenentatge)
@@ -79,19 +79,11 @@ def retain_case(
     utilitat = q_user * (1 + alpha * math.log(1 + k_adapt))
 
     # 4. FILTRE DE REDUNDÀNCIA (Diversitat)
-    # Cerquem la similitud amb el cas més proper de la BC
+    # Cerquem la distància al cas més proper amb l'índex del Retriever (surt en trobar-ne un dins de GAMMA)
     if not hasattr(kb_instance, "base_casos") or not kb_instance.base_casos:
-        kb_instance.base_casos = _carregar_bc_existent()
+        kb_instance.base_casos = _carregar_bc_existent(retriever_instance)
 
-    sim_max = 0.0
-    for existing in kb_instance.base_casos:
-        try:
-            res = retriever_instance._score(new_case["problema"], existing)
-            sim = res.get("score_final", 0.0)
-            if sim > sim_max: sim_max = sim
-        except: continue
-
-    d_min = 1.0 - sim_max
+    d_min = retriever_instance.distancia_minima(new_case["problema"], radi=GAMMA)
     if d_min < GAMMA:
         print("[DECISIÓ: DESCARTAT PER REDUNDÀNCIA]")
         print("    • El cas no aporta prou novetat a la Base de Casos.")
@@ -100,7 +92,7 @@ def retain_case(
 
     # 5. DECISIÓ FINAL I PERSISTÈNCIA
     if utilitat > LLINDAR_UTILITAT:
-        return _persistir_cas(kb_instance, new_case, k_adapt, utilitat, user_score, transformation_log)
+        return _persistir_cas(kb_instance, new_case, k_adapt, utilitat, user_score, transformation_log, retriever_instance)
 
     print("[DECISIÓ: DESCARTAT PER BAIXA UTILITAT]")
     print(f" • Utilitat calculada (U={utilitat:.2f}) inferior al llindar ({LLINDAR_UTILITAT}).")
@@ -110,15 +102,15 @@ def retain_case(
 
 # --- AUXILIARS DE PERSISTÈNCIA ---
 
-def _carregar_bc_existent() -> List[Dict]:
+def _magatzem(retriever: Any = None) -> MagatzemCasos:
+    """Magatzem de la BC: el mateix que usa el Retriever si en té, sinó el de PATH_BC."""
+    return getattr(retriever, "magatzem", None) or obrir_magatzem(PATH_BC)
+
+def _carregar_bc_existent(retriever: Any = None) -> List[Dict]:
     """Carrega la base de casos de disc si no està en memòria."""
-    if os.path.exists(PATH_BC):
-        with open(PATH_BC, "r", encoding="utf-8") as f:
-            try: return json.load(f)
-            except: return []
-    return []
+    return _magatzem(retriever).carregar()
 
-def _persistir_cas(kb, case, k_adapt, utilitat, score, logs) -> bool:
+def _persistir_cas(kb, case, k_adapt, utilitat, score, logs, retriever=None) -> bool:
     """Serialitza i guarda el cas amb l'estructura canònica."""
     prob = case["problema"]
     solu = case.get("solucio", {})
@@ -142,8 +134,10 @@ def _persistir_cas(kb, case, k_adapt, utilitat, score, logs) -> bool:
             })
 
     # Estructura final del cas per a la BC
+    # Amb el backend multiusuari l'id l'assigna SQLite a la inserció (len + 1 col·lidiria entre processos)
+    magatzem = _magatzem(retriever)
     final_entry = {
-        "id_cas": len(kb.base_casos) + 1,
+        "id_cas": None if isinstance(magatzem, MagatzemCasosSQLite) else len(kb.base_casos) + 1,
         "problema": {
             "tipus_esdeveniment": get_val(prob, "tipus_esdeveniment"),
             "estil_culinari": get_val(prob, "estil_culinari"),
@@ -166,9 +160,13 @@ def _persistir_cas(kb, case, k_adapt, utilitat, score, logs) -> bool:
         }
     }
 
+    # Persistència append-only: una línia al registre en lloc de reescriure tota la BC
     kb.base_casos.append(final_entry)
-    with open(PATH_BC, "w", encoding="utf-8") as f:
-        json.dump(kb.base_casos, f, indent=4, ensure_ascii=False)
+    rowid = magatzem.afegir(final_entry)
+
+    # Actualització incremental de l'índex del Retriever (sense recarregar el JSON)
+    if hasattr(retriever, "add_case"):
+        retriever.add_case(final_entry, rowid=rowid)
     
     print("[DECISIÓ: APRÈS I RETINGUT]")
     print("El cas s'ha incorporat exitosament a la memòria a llarg termini pels següents motius:")
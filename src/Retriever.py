@@ -1,7 +1,9 @@
-import json
 import math
-from typing import Dict, Any, List, Optional
+from collections import Counter, OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
 from estructura_cas import DescripcioProblema
+from magatzem_casos import compleix_prefiltre, obrir_magatzem
 
 class Retriever:
     """
@@ -27,17 +29,55 @@ class Retriever:
     INFORMALS = {"cocktail", "finger_food", "buffet"}
     SEASONS = ["primavera", "estiu", "tardor", "hivern"]
 
-    def __init__(self, path_base_casos: str):
-        self.base_casos = self._carregar_base_casos(path_base_casos)
+    # --- COLUMNES DE L'ÍNDEX (nom -> dtype) ---
+    CAMPS_INDEX = {
+        "event": np.int64, "event_grup": np.int64,
+        "servei": np.int64, "servei_informal": bool, "servei_indif": bool,
+        "temp": np.int64, "temp_idx": np.int64, "temp_indif": bool,
+        "formal": np.int64,
+        "pax": float, "pax_ok": bool,
+        "preu": float, "preu_ok": bool,
+        "n_restr": float,
+    }
 
-    def _carregar_base_casos(self, path: str) -> List[Dict]:
-        """Carrega la base de casos des del fitxer JSON."""
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            print(f"[Retriever]: No s'ha pogut carregar {path}")
-            return []
+    # Mida mínima de la BC a partir de la qual compensa el branch-and-bound per particions
+    MIN_CASOS_PARTICIONS = 512
+
+    def __init__(self, path_base_casos: str, mida_cache: int = 256,
+                 bucket_pax: Optional[float] = None, bucket_preu: Optional[float] = None):
+        # Cache LRU de consultes (signatura canònica -> resultats). Es buida quan canvia la BC.
+        self.mida_cache = mida_cache
+        self.bucket_pax, self.bucket_preu = bucket_pax, bucket_preu
+        self._cache: "OrderedDict[Tuple, List[Dict]]" = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Backend segons l'extensió: JSON + registre, o SQLite (.db) per a ús multiusuari
+        self.magatzem = obrir_magatzem(path_base_casos)
+        if hasattr(self.magatzem, "carregar_files"):
+            # Amb SQLite l'índex recorda el rowid de cada cas (id_cas no és únic)
+            files = self.magatzem.carregar_files()
+            self._construir_index([cas for _, cas in files], [rowid for rowid, _ in files])
+        else:
+            self._construir_index(self._carregar_base_casos())
+
+    @property
+    def base_casos(self) -> List[Dict]:
+        """Casos actius de l'índex, en ordre d'inserció."""
+        return [cas for cas in self._casos if cas is not None]
+
+    def _carregar_base_casos(self) -> List[Dict]:
+        """Carrega la base de casos (snapshot JSON + registre de casos apresos, o taula SQLite)."""
+        return self.magatzem.carregar()
+
+    def sincronitzar(self) -> int:
+        """Incorpora a l'índex els casos que altres processos han afegit al magatzem (només SQLite)."""
+        if not hasattr(self.magatzem, "casos_nous"):
+            return 0
+        nous = self.magatzem.casos_nous()
+        for rowid, cas in nous:
+            self.add_case(cas, rowid=rowid)
+        return len(nous)
 
     # --- UTILITATS ---
 
@@ -45,6 +85,278 @@ class Retriever:
         """Normalitza cadenes de text per a comparacions."""
         return str(x).strip().lower() if x else ""
 
+    def _a_float(self, x: Any) -> Tuple[float, bool]:
+        """Converteix a float indicant si el valor és vàlid (mateix criteri que _sim_pax/_sim_preu)."""
+        try:
+            return float(x), True
+        except (ValueError, TypeError):
+            return 0.0, False
+
+    def _grup_event(self, a: str) -> int:
+        """Codi de grup semàntic d'esdeveniment: 1 familiar, 2 corporatiu, 0 sense grup."""
+        if a in self.FAMILIARS: return 1
+        if a in self.CORPORATIUS: return 2
+        return 0
+
+    def _codi(self, valor: Any) -> int:
+        """Codi enter del valor normalitzat dins del vocabulari categòric (-1 si és desconegut)."""
+        return self._vocab.get(self._norm(valor), -1)
+
+    # --- ÍNDEX COLUMNAR (Càlcul vectoritzat) ---
+
+    def _construir_index(self, casos: List[Dict], rowids: Optional[List[int]] = None) -> None:
+        """
+        Codifica la base de casos en columnes NumPy una sola vegada (a la càrrega).
+        Cada atribut del problema queda com un array de N posicions, de manera que
+        les set similituds locals es calculen amb operacions vectorials.
+        Les columnes es reserven amb capacitat extra perquè add_case sigui O(1) amortitzat.
+        """
+        self._vocab: Dict[str, int] = {}
+        self._vocab_restr: Dict[str, int] = {}
+        self._casos: List[Optional[Dict]] = []      # Slot -> cas (None si s'ha eliminat)
+        self._slot_per_id: Dict[Any, int] = {}
+        self._rowid_per_slot: List[Optional[int]] = []  # Slot -> rowid del magatzem SQLite (None si no n'hi ha)
+        self._slot_per_rowid: Dict[int, int] = {}
+        self._n = 0                                 # Slots ocupats (inclou eliminats)
+        self._n_actius = 0
+        self._particions: Dict[Tuple[int, int], Dict[str, Any]] = {}
+
+        cap = max(16, len(casos))
+        self._arrays = {k: np.zeros(cap, dtype=t) for k, t in self.CAMPS_INDEX.items()}
+        self._restr = np.zeros((cap, 8), dtype=float)  # Bitmask de restriccions (N x R)
+        self._actiu = np.zeros(cap, dtype=bool)
+
+        for cas, rowid in zip(casos, rowids or [None] * len(casos)):
+            self.add_case(cas, rowid=rowid)
+
+    def _reservar(self, files: int, columnes_restr: int) -> None:
+        """Amplia la capacitat de les columnes (duplicant) quan cal."""
+        cap = len(self._actiu)
+        if files > cap:
+            nova = max(files, 2 * cap)
+            for k, arr in self._arrays.items():
+                self._arrays[k] = np.concatenate([arr, np.zeros(nova - cap, dtype=arr.dtype)])
+            self._actiu = np.concatenate([self._actiu, np.zeros(nova - cap, dtype=bool)])
+            self._restr = np.vstack([self._restr, np.zeros((nova - cap, self._restr.shape[1]))])
+        if columnes_restr > self._restr.shape[1]:
+            nova = max(columnes_restr, 2 * self._restr.shape[1])
+            self._restr = np.hstack([self._restr, np.zeros((self._restr.shape[0], nova - self._restr.shape[1]))])
+
+    def _columnes(self, slots: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """Vistes de les columnes ocupades de l'índex (o només de les files indicades a 'slots')."""
+        if slots is None:
+            c = {k: arr[:self._n] for k, arr in self._arrays.items()}
+            c["restr"] = self._restr[:self._n, :len(self._vocab_restr)]
+        else:
+            c = {k: arr[slots] for k, arr in self._arrays.items()}
+            c["restr"] = self._restr[slots, :len(self._vocab_restr)]
+        return c
+
+    # --- PARTICIONS (Blocking per grup d'esdeveniment i de servei) ---
+
+    def _clau_particio(self, slot: int) -> Tuple[int, int]:
+        """Clau (grup d'esdeveniment, grup de servei) d'un slot. Servei: 2 indiferent, 1 informal, 0 altres."""
+        a = self._arrays
+        servei = 2 if a["servei_indif"][slot] else (1 if a["servei_informal"][slot] else 0)
+        return int(a["event_grup"][slot]), servei
+
+    def _registrar_particio(self, slot: int) -> None:
+        part = self._particions.setdefault(
+            self._clau_particio(slot), {"slots": {}, "events": Counter(), "serveis": Counter(), "array": None}
+        )
+        part["slots"][slot] = None
+        part["events"][int(self._arrays["event"][slot])] += 1
+        part["serveis"][int(self._arrays["servei"][slot])] += 1
+        part["array"] = None
+
+    def _desregistrar_particio(self, slot: int) -> None:
+        part = self._particions[self._clau_particio(slot)]
+        del part["slots"][slot]
+        for camp, col in (("events", "event"), ("serveis", "servei")):
+            codi = int(self._arrays[col][slot])
+            part[camp][codi] -= 1
+            if part[camp][codi] <= 0:
+                del part[camp][codi]
+        part["array"] = None
+
+    def _slots_particio(self, part: Dict[str, Any]) -> np.ndarray:
+        """Slots d'una partició com a array (es reconstrueix només si la partició ha canviat)."""
+        if part["array"] is None:
+            part["array"] = np.fromiter(part["slots"], dtype=np.int64, count=len(part["slots"]))
+        return part["array"]
+
+    def _cota_particio(self, q: Dict[str, Any], clau: Tuple[int, int], part: Dict[str, Any]) -> float:
+        """
+        Cota superior del score global dins d'una partició.
+        Esdeveniment i servei es fiten amb els codis presents; la resta de mètriques valen com a màxim 1.0.
+        """
+        grup_event, grup_servei = clau
+        if q["event"] in part["events"]: s_event = 1.0
+        elif grup_event > 0 and grup_event == q["event_grup"]: s_event = 0.7
+        else: s_event = 0.2
+
+        if q["servei_indif"] or grup_servei == 2 or q["servei"] in part["serveis"]: s_servei = 1.0
+        elif grup_servei == 1 and q["servei_informal"]: s_servei = 0.8
+        else: s_servei = 0.2
+
+        resta = sum(w for m, w in self.W.items() if m not in ("event", "servei"))
+        return self.W["event"] * s_event + self.W["servei"] * s_servei + resta
+
+    def _particions_per_cota(self, q: Dict[str, Any]) -> List[Tuple[float, Tuple[int, int]]]:
+        """Particions no buides ordenades per cota superior decreixent."""
+        return sorted(
+            ((self._cota_particio(q, clau, part), clau) for clau, part in self._particions.items() if part["slots"]),
+            reverse=True,
+        )
+
+    def distancia_minima(self, peticio: Any, radi: float = 0.0) -> float:
+        """
+        Distància (1 - score) al cas més proper de la BC, per al filtre de redundància del Retain.
+        Recorre les particions per cota decreixent i surt tan aviat com troba un cas dins del radi.
+        """
+        self.sincronitzar()  # Inclou els casos que altres processos han retingut
+        q = self._codificar_peticio(peticio)
+        sim_max = 0.0
+        for cota, clau in self._particions_per_cota(q):
+            if cota + 1e-9 < sim_max:
+                break  # Cap partició restant pot tenir un veí més proper
+            slots = self._slots_particio(self._particions[clau])
+            scores = self._agregar(self._similituds_vectoritzades(q, slots), parcial=True)
+            sim_max = max(sim_max, float(scores.max()))
+            if 1.0 - sim_max < radi:
+                break  # Sortida anticipada: ja hi ha un cas dins del radi d'exclusió
+        return 1.0 - sim_max
+
+    def _cerca_particions(self, q: Dict[str, Any], k: int) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Branch-and-bound sobre les particions: s'avaluen per cota decreixent i es descarten
+        les que no poden superar el k-èsim millor score actual.
+        Retorna (slots, scores, sims) dels k millors, ordenats com la cerca exhaustiva.
+        """
+        slots_av, scores_av, sims_av = [], [], []
+        kesim = -np.inf
+        for cota, clau in self._particions_per_cota(q):
+            if cota + 1e-9 < kesim:
+                break  # Cap cas restant pot entrar al top-k (ni empatant)
+            slots = self._slots_particio(self._particions[clau])
+            sims = self._similituds_vectoritzades(q, slots)
+            slots_av.append(slots)
+            scores_av.append(self._agregar(sims, parcial=True))
+            sims_av.append(sims)
+
+            tots = np.concatenate(scores_av)
+            if len(tots) >= k:
+                kesim = np.partition(tots, len(tots) - k)[len(tots) - k]
+
+        slots = np.concatenate(slots_av)
+        scores = np.concatenate(scores_av)
+        sims = {m: np.concatenate([s[m] for s in sims_av]) for m in self.W}
+        ordre = np.lexsort((slots, -scores))[:k]  # Score decreixent, desempat per posició a la BC
+        return slots[ordre], scores[ordre], {m: v[ordre] for m, v in sims.items()}
+
+    def _codificar_cas(self, cas: Dict) -> Tuple[Dict[str, Any], List[int]]:
+        """Codifica el problema d'un cas: valors de les columnes + índexs de restriccions."""
+        p = cas.get("problema", {})
+        event, servei, temp = self._norm(p.get("tipus_esdeveniment")), self._norm(p.get("servei")), self._norm(p.get("temporada"))
+        pax, pax_ok = self._a_float(p.get("n_comensals"))
+        preu, preu_ok = self._a_float(p.get("preu_pers_objectiu", p.get("preu_pers")))
+        restr = {self._norm(r) for r in (p.get("restriccions") or []) if r}
+        idx_restr = [self._vocab_restr.setdefault(r, len(self._vocab_restr)) for r in restr]
+
+        def codi(valor: Any) -> int:
+            return self._vocab.setdefault(self._norm(valor), len(self._vocab))
+
+        fila = {
+            "event": codi(event), "event_grup": self._grup_event(event),
+            "servei": codi(servei), "servei_informal": servei in self.INFORMALS, "servei_indif": servei == "indiferent",
+            "temp": codi(temp), "temp_idx": self.SEASONS.index(temp) if temp in self.SEASONS else -1, "temp_indif": temp == "indiferent",
+            "formal": codi(p.get("formalitat")),
+            "pax": pax, "pax_ok": pax_ok, "preu": preu, "preu_ok": preu_ok,
+            "n_restr": len(restr),
+        }
+        return fila, idx_restr
+
+    def add_case(self, cas: Dict, rowid: Optional[int] = None) -> None:
+        """
+        Afegeix un cas a l'índex de recuperació (O(1) amortitzat, sense rellegir el JSON).
+        'rowid' és la fila del magatzem SQLite, si n'hi ha (clau dels prefiltres SQL).
+        """
+        self._cache.clear()
+        fila, idx_restr = self._codificar_cas(cas)
+
+        i = self._n
+        self._reservar(i + 1, len(self._vocab_restr))
+        for k, v in fila.items():
+            self._arrays[k][i] = v
+        self._restr[i, :] = 0.0
+        self._restr[i, idx_restr] = 1.0
+        self._actiu[i] = True
+        self._registrar_particio(i)
+
+        self._casos.append(cas)
+        if cas.get("id_cas") is not None:
+            self._slot_per_id[cas["id_cas"]] = i
+        self._rowid_per_slot.append(rowid)
+        if rowid is not None:
+            self._slot_per_rowid[rowid] = i
+        self._n += 1
+        self._n_actius += 1
+
+    def remove_case(self, id_cas: Any) -> bool:
+        """Retira un cas de l'índex pel seu id_cas. Retorna False si no hi era."""
+        slot = self._slot_per_id.pop(id_cas, None)
+        if slot is None:
+            return False
+        self._cache.clear()
+        self._actiu[slot] = False
+        self._desregistrar_particio(slot)
+        self._casos[slot] = None
+        if self._rowid_per_slot[slot] is not None:
+            self._slot_per_rowid.pop(self._rowid_per_slot[slot], None)
+        self._n_actius -= 1
+
+        # Compactació amortitzada quan els forats superen la meitat dels slots
+        if self._n - self._n_actius > max(16, self._n // 2):
+            self._compactar()
+        return True
+
+    def _compactar(self) -> None:
+        """Elimina els slots buits mantenint l'ordre d'inserció (i per tant els desempats)."""
+        keep = np.flatnonzero(self._actiu[:self._n])
+        for k, arr in self._arrays.items():
+            self._arrays[k] = arr[keep].copy()
+        self._restr = self._restr[keep].copy()
+        self._actiu = np.ones(len(keep), dtype=bool)
+        self._casos = [self._casos[i] for i in keep]
+        self._slot_per_id = {cas["id_cas"]: i for i, cas in enumerate(self._casos) if cas.get("id_cas") is not None}
+        self._rowid_per_slot = [self._rowid_per_slot[i] for i in keep]
+        self._slot_per_rowid = {rowid: i for i, rowid in enumerate(self._rowid_per_slot) if rowid is not None}
+        self._n = self._n_actius = len(keep)
+        self._reservar(max(16, self._n), self._restr.shape[1])
+        self._particions = {}
+        for slot in range(self._n):
+            self._registrar_particio(slot)
+
+    def _codificar_peticio(self, req: Any) -> Dict[str, Any]:
+        """Codifica una petició amb el mateix vocabulari que l'índex columnar."""
+        r_d = req.to_dict() if hasattr(req, 'to_dict') else req
+        event, servei, temp = self._norm(r_d.get("tipus_esdeveniment")), self._norm(r_d.get("servei")), self._norm(r_d.get("temporada"))
+        pax, pax_ok = self._a_float(r_d.get("n_comensals"))
+        preu, preu_ok = self._a_float(r_d.get("preu_pers_objectiu"))
+
+        restr = {self._norm(r) for r in (r_d.get("restriccions") or []) if r}
+        vec_restr = np.zeros(len(self._vocab_restr), dtype=float)
+        vec_restr[[self._vocab_restr[r] for r in restr if r in self._vocab_restr]] = 1.0
+
+        return {
+            "event": self._codi(event), "event_grup": self._grup_event(event),
+            "servei": self._codi(servei), "servei_informal": servei in self.INFORMALS, "servei_indif": servei == "indiferent",
+            "temp": self._codi(temp), "temp_idx": self.SEASONS.index(temp) if temp in self.SEASONS else -1, "temp_indif": temp == "indiferent",
+            "formal": self._codi(r_d.get("formalitat")),
+            "pax": pax, "pax_ok": pax_ok, "preu": preu, "preu_ok": preu_ok,
+            "restr": vec_restr, "n_restr": len(restr),
+        }
+
     # --- MÈTRIQUES DE SIMILITUD LOCAL ---
 
     def _sim_event(self, a: str, b: str) -> float:
@@ -126,13 +438,206 @@ class Retriever:
             "detall": sims
         }
 
-    def recuperar_casos_similars(self, peticio: DescripcioProblema, k: int = 3) -> List[Dict]:
-        """Retorna els top-k casos (k-NN) ordenats per similitud decreixent."""
-        scored = []
-        for cas in self.base_casos:
-            res = self._score(peticio, cas)
-            scored.append({**res, "cas": cas})
-        
-        # Ordenem per score_final de més a menys similar
-        scored.sort(key=lambda x: x["score_final"], reverse=True)
-        return scored[:k]
\ No newline at end of file
+    def _codificar_lot(self, peticions: List[Any]) -> Dict[str, np.ndarray]:
+        """Apila M peticions codificades en columnes (M x 1) perquè facin broadcasting contra els N casos."""
+        codis = [self._codificar_peticio(p) for p in peticions]
+        lot = {}
+        for camp in codis[0]:
+            if camp == "restr":
+                lot[camp] = np.vstack([q[camp] for q in codis]).reshape(len(codis), -1)
+            else:
+                lot[camp] = np.array([q[camp] for q in codis])[:, None]
+        return lot
+
+    def _similituds_vectoritzades(self, q: Dict[str, Any], slots: Optional[np.ndarray] = None,
+                                  columnes: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+        """
+        Versió columnar de les mètriques locals (_sim_event, _sim_servei, ...).
+        Retorna un array de similituds per cas i per mètrica, amb valors idèntics als de _score.
+        Accepta una petició (arrays de N) o un lot codificat per _codificar_lot (matrius M x N).
+        Amb 'slots' només es calculen les files indicades (cerca per particions);
+        amb 'columnes', unes columnes codificades fora de l'índex (supervivents d'un prefiltre SQL).
+        """
+        c = self._columnes(slots) if columnes is None else columnes
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            grup_comu = (c["event_grup"] == q["event_grup"]) & (c["event_grup"] > 0)
+            s_event = np.where(c["event"] == q["event"], 1.0, np.where(grup_comu, 0.7, 0.2))
+
+            servei_ok = (c["servei"] == q["servei"]) | c["servei_indif"] | q["servei_indif"]
+            s_servei = np.where(servei_ok, 1.0, np.where(c["servei_informal"] & q["servei_informal"], 0.8, 0.2))
+
+            inter = q["restr"] @ c["restr"].T
+            unio = c["n_restr"] + q["n_restr"] - inter
+            s_restr = np.where(q["n_restr"] > 0, inter / np.maximum(unio, 1.0), 1.0)
+
+            dist = np.abs(c["temp_idx"] - q["temp_idx"])
+            ciclica = 1.0 - (np.minimum(dist, 4 - dist) * 0.5)
+            temp_ok = (c["temp"] == q["temp"]) | c["temp_indif"] | q["temp_indif"]
+            s_temp = np.where(temp_ok, 1.0, np.where((c["temp_idx"] >= 0) & (q["temp_idx"] >= 0), ciclica, 0.4))
+
+            s_formal = np.where(c["formal"] == q["formal"], 1.0, 0.5)
+
+            s_pax = np.where(c["pax_ok"] & q["pax_ok"], 1.0 / (1.0 + 0.01 * np.abs(q["pax"] - c["pax"])), 0.5)
+
+            t, a = q["preu"], c["preu"]
+            decai = np.maximum(0.1, np.exp(-4.0 * ((a - t) / t)))
+            s_preu = np.where(c["preu_ok"] & q["preu_ok"], np.where((t <= 0) | (a <= t), 1.0, decai), 0.8)
+
+        return {'event': s_event, 'servei': s_servei, 'restr': s_restr, 'temp': s_temp,
+                'formal': s_formal, 'pax': s_pax, 'preu': s_preu}
+
+    def _agregar(self, sims: Dict[str, np.ndarray], parcial: bool = False) -> np.ndarray:
+        """
+        Suma ponderada segons self.W (mateix ordre d'acumulació que _score).
+        Sobre tot l'índex, els slots eliminats queden a -inf; amb 'parcial' (files ja seleccionades) no cal.
+        """
+        total = 0.0
+        for k, w in self.W.items():
+            total = total + w * sims[k]
+        if not parcial and self._n_actius < self._n:
+            total = np.where(self._actiu[:self._n], total, -np.inf)
+        return total
+
+    def _top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Selecciona els k millors índexs amb np.partition (O(N)) en lloc d'ordenar-ho tot.
+        Desempata per posició a la BC, igual que una ordenació estable completa.
+        """
+        n = len(scores)
+        if k < 0:
+            k = max(0, self._n_actius + k)  # Mateixa semàntica que el slicing [:k]
+        k = min(k, self._n_actius)  # Els slots eliminats tenen score -inf i mai entren
+        if k <= 0 or k >= n:
+            return np.argsort(-scores, kind="stable")[:k]
+
+        llindar = np.partition(scores, n - k)[n - k]  # k-èsim score més alt
+        majors = np.flatnonzero(scores > llindar)
+        empats = np.flatnonzero(scores == llindar)[: k - len(majors)]
+        seleccio = np.concatenate([majors, empats])
+        return seleccio[np.argsort(-scores[seleccio], kind="stable")]
+
+    def _materialitzar(self, i: int, scores: np.ndarray, sims: Dict[str, np.ndarray], slot: Optional[int] = None) -> Dict[str, Any]:
+        """Construeix el resultat (amb el desglossament 'detall') només per a un cas guanyador."""
+        return {
+            "score_final": float(scores[i]),
+            "detall": {m: float(v[i]) for m, v in sims.items()},
+            "cas": self._casos[i if slot is None else slot],
+        }
+
+    # --- CACHE DE CONSULTES ---
+
+    def _signatura(self, peticio: Any, k: int) -> Tuple:
+        """
+        Clau canònica d'una petició: només els atributs que intervenen a la similitud, normalitzats.
+        Amb bucket_pax / bucket_preu, els valors propers comparteixen entrada (resultat aproximat).
+        """
+        def camp(nom: str) -> Any:
+            return peticio.get(nom) if isinstance(peticio, dict) else getattr(peticio, nom, None)
+
+        def numeric(valor: Any, bucket: Optional[float]) -> Any:
+            x, ok = self._a_float(valor)
+            if not ok:
+                return None
+            return math.floor(x / bucket) if bucket and math.isfinite(x) else x
+
+        return (
+            self._norm(camp("tipus_esdeveniment")), self._norm(camp("servei")),
+            self._norm(camp("temporada")), self._norm(camp("formalitat")),
+            frozenset(self._norm(r) for r in (camp("restriccions") or []) if r),
+            numeric(camp("n_comensals"), self.bucket_pax),
+            numeric(camp("preu_pers_objectiu"), self.bucket_preu),
+            k,
+        )
+
+    def estadistiques_cache(self) -> Dict[str, Any]:
+        """Comptadors d'encerts/errades de la cache de consultes."""
+        total = self.cache_hits + self.cache_misses
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "entrades": len(self._cache),
+            "taxa_encert": self.cache_hits / total if total else 0.0,
+        }
+
+    def recuperar_casos_similars(self, peticio: DescripcioProblema, k: int = 3,
+                                 prefiltre: Optional[Dict[str, Any]] = None) -> List[Dict]:
+        """
+        Retorna els top-k casos (k-NN) ordenats per similitud decreixent (amb cache LRU).
+        'prefiltre' restringeix la cerca als casos que compleixen condicions grolleres sobre
+        el problema (p.ex. {"servei": ["còctel", "bufet"], "n_comensals": (50, 200)});
+        amb el backend SQLite s'avalua en SQL i només es puntuen els supervivents.
+        """
+        self.sincronitzar()
+        if prefiltre:
+            return self._recuperar_prefiltrats(peticio, k, prefiltre)
+        if self.mida_cache <= 0:
+            return self._recuperar_casos_similars(peticio, k)
+
+        clau = self._signatura(peticio, k)
+        if clau in self._cache:
+            self._cache.move_to_end(clau)
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            self._cache[clau] = self._recuperar_casos_similars(peticio, k)
+            if len(self._cache) > self.mida_cache:
+                self._cache.popitem(last=False)
+
+        # Còpia superficial perquè el consumidor no alteri l'entrada de la cache
+        return [{**res, "detall": dict(res["detall"])} for res in self._cache[clau]]
+
+    def _recuperar_casos_similars(self, peticio: Any, k: int) -> List[Dict]:
+        """Recuperació sense cache (índex columnar / particions)."""
+        if not self._n_actius:
+            return []
+
+        q = self._codificar_peticio(peticio)
+        if self._n_actius >= self.MIN_CASOS_PARTICIONS and 0 < k < self._n_actius:
+            slots, scores, sims = self._cerca_particions(q, k)
+            return [self._materialitzar(j, scores, sims, int(slot)) for j, slot in enumerate(slots)]
+
+        sims = self._similituds_vectoritzades(q)
+        scores = self._agregar(sims)
+
+        # Només es materialitzen els k guanyadors (assignació O(k) per petició)
+        return [self._materialitzar(i, scores, sims) for i in self._top_k(scores, k)]
+
+    def _recuperar_prefiltrats(self, peticio: Any, k: int, prefiltre: Dict[str, Any]) -> List[Dict]:
+        """Recuperació restringida als casos que passen el prefiltre (sense cache)."""
+        if hasattr(self.magatzem, "filtrar"):
+            # SQL retorna els rowids supervivents; només es puntuen els que són actius a l'índex
+            slots = sorted(s for rowid in self.magatzem.filtrar(prefiltre) if (s := self._slot_per_rowid.get(rowid)) is not None)
+        else:
+            slots = [i for i, cas in enumerate(self._casos) if cas is not None and compleix_prefiltre(cas, prefiltre)]
+        if not slots:
+            return []
+        casos = [self._casos[i] for i in slots]
+        sims = self._similituds_vectoritzades(self._codificar_peticio(peticio), np.array(slots, dtype=int))
+
+        scores = self._agregar(sims, parcial=True)
+        return [
+            {"score_final": float(scores[i]), "detall": {m: float(v[i]) for m, v in sims.items()}, "cas": casos[i]}
+            for i in np.argsort(-scores, kind="stable")[:k]
+        ]
+
+    def recuperar_batch(self, peticions: List[DescripcioProblema], k: int = 3) -> List[List[Dict]]:
+        """
+        Recupera els top-k casos per a un lot de peticions.
+        Calcula una sola matriu M x N de similituds i retorna, per a cada petició,
+        la mateixa llista que en retornaria recuperar_casos_similars.
+        """
+        peticions = list(peticions)
+        if not peticions:
+            return []
+        self.sincronitzar()
+        if not self._n_actius:
+            return [[] for _ in peticions]
+
+        sims = self._similituds_vectoritzades(self._codificar_lot(peticions))
+        scores = self._agregar(sims)
+
+        resultats = []
+        for fila in range(len(peticions)):
+            sims_fila = {m: v[fila] for m, v in sims.items()}
+            resultats.append([self._materialitzar(i, scores[fila], sims_fila) for i in self._top_k(scores[fila], k)])
+        return resultats
@@ -1,28 +1,87 @@
+import json
+import os
 import pickle
-import pandas as pd
+import sys
+import threading
 import numpy as np
 import random
 import unicodedata
-from typing import List, Tuple, Optional
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Dict, List, Tuple, Optional
+from index_ivf import IndexIVF
 """
 GESTIÓ DEL NIVELL SUBSIMBÒLIC (FlavorGraph)
 Implementa la representació latent del sistema.
 Gestiona l'espai vectorial n-dimensional per calcular afinitats químiques
 i generar candidats creatius segons Pairing.
+
+Els embeddings es poden precompilar (build_store) en una matriu float32 contigua (.npy)
+més un índex de noms (.json); el wrapper la carrega amb np.load(mmap_mode='r'), de manera
+que l'arrencada és immediata i diversos processos comparteixen les mateixes pàgines físiques.
+El store inclou també la matriu normalitzada (files unitàries) que fan servir les cerques
+de veïns; els noms no elegibles com a candidats hi queden com a files NaN.
+Opcionalment (ann=True) les cerques de veïns passen per un índex IVF aproximat
+construït offline (build_ann_index / python src/index_ivf.py) i desat al mateix directori.
+En mode compacte (compact=True) només es manté una matriu (float32 o float16) i un vector
+d'inverses de norma; name_to_vector passa a ser una vista per índex sobre aquesta matriu.
+LazyFlavorGraphWrapper difereix tota la càrrega fins al primer ús (o a un prefetch en segon pla).
+    python src/flavorgraph_embeddings.py [model.pickle] [nodes.csv] [directori_sortida]
 """
 
+STORE_MATRIX = "FlavorGraph_Node_Embedding.npy"
+STORE_NAMES = "FlavorGraph_Node_Names.json"
+STORE_UNIT = "FlavorGraph_Node_Unit.npy"
+STORE_IVF = "FlavorGraph_IVF.npz"
+
+
+def _resident_bytes() -> int:
+    """Memòria resident del procés (VmRSS a Linux; si no, el pic de getrusage)."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for linia in f:
+                if linia.startswith("VmRSS:"):
+                    return int(linia.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return 0
+
+
+class _IndexedVectors(Mapping):
+    """Vista nom -> fila de la matriu, sense guardar un objecte per vector (mode compacte)."""
+
+    def __init__(self, name_to_idx: Dict[str, int], matrix: np.ndarray):
+        self._name_to_idx = name_to_idx
+        self._matrix = matrix
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._matrix[self._name_to_idx[name]]
+
+    def __iter__(self):
+        return iter(self._name_to_idx)
+
+    def __len__(self) -> int:
+        return len(self._name_to_idx)
+
 class FlavorGraphWrapper:
-    def __init__(self, model_path: str = "models/FlavorGraph_Node_Embedding.pickle", nodes_path: str = "models/nodes_191120.csv"):
-        # Carreguem Embeddings FlavorGraph
-        with open(model_path, "rb") as f:
-            self.raw_embeddings = pickle.load(f)
-            
-        # Carreguem Metadades i mapeig noms -> vectors
-        df = pd.read_csv(nodes_path)
-        df.columns = [c.lower() for c in df.columns]
-        
-        self.name_to_vector = {} 
-        self.valid_ingredients = set()
+    # Criteris de candidat a les cerques de veïns
+    MAX_NAME_LEN = 25        # Noms llargs (descripcions, compostos) no es proposen
+    MAX_SIMILARITY = 0.999   # Quasi-idèntics (el mateix node) no es proposen
+    COMPACT_BLOCK = 4096     # Files per bloc en els productes amb matrius float16
+
+    def __init__(self, model_path: str = "models/FlavorGraph_Node_Embedding.pickle", nodes_path: str = "models/nodes_191120.csv",
+                 store_dir: Optional[str] = None, mida_cache: int = 4096, ann: bool = False, n_sondes: int = 8,
+                 compact: bool = False, dtype: str = "float32"):
+        # Cache LRU de resolució de noms (nom en brut -> índex del node, també None si no existeix)
+        self.mida_cache = mida_cache
+        self._cache_noms: "OrderedDict[str, Optional[int]]" = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         # Normalització manual per sinònims culinaris comuns
         self.alias_map = {
             "prawns": "shrimp", "prawn": "shrimp", "garbanzo": "chickpea",
@@ -31,31 +90,185 @@ class FlavorGraphWrapper:
             "maize": "corn", "sweetcorn": "corn", "courgette": "zucchini", "aubergine": "eggplant",
         }
 
-        for _, row in df.iterrows():
-            node_id = str(row['node_id'])
-            name = str(row['name'])
-            node_type = str(row['type']).lower() if 'type' in df.columns else ""
+        # Store precompilat (si és al dia respecte les fonts); si no, es llegeix el pickle i es desa
+        store_dir = store_dir if store_dir is not None else os.path.dirname(model_path)
+        self.store_dir = store_dir
+        self.compact = compact
+        self.mmap = self._store_al_dia(store_dir, model_path, nodes_path)
+        if self.mmap:
+            self.raw_embeddings = None
+            names, matrix, unit = self._load_store(store_dir)
+        else:
+            with open(model_path, "rb") as f:
+                self.raw_embeddings = pickle.load(f)
+            names, matrix = self._build_matrix(self.raw_embeddings, nodes_path)
+            unit = None
+        if unit is None:
+            unit = self._unit_matrix(names, matrix)
+            try:
+                self._save_store(store_dir, names, matrix, unit)
+            except OSError:
+                print(f"[FlavorGraph]: No s'ha pogut desar el store a {store_dir}")
+
+        if compact:
+            # Una sola matriu: es descarten el pickle i la matriu unitària (no es llegeix del mmap)
+            self.raw_embeddings = None
+            unit = None
+            if matrix.dtype != np.dtype(dtype):
+                matrix = matrix.astype(dtype)
+                self.mmap = False
+
+        # Mapeig noms -> vectors (vistes sobre les files de la matriu)
+        self._name_to_idx = {name: i for i, name in enumerate(names)}
+        self.name_to_vector = _IndexedVectors(self._name_to_idx, matrix) if compact else dict(zip(names, matrix))
+        self.valid_ingredients = set(names)
+
+        # Preparem la cache per a cerques ràpides
+        self._prepare_cache(names, matrix, unit)
+        self._ngram_index: Optional[Dict[str, List[int]]] = None  # Es construeix a la primera cerca parcial
 
+        # Índex aproximat (IVF) si s'ha demanat i està construït per a aquest store
+        self.ann: Optional[IndexIVF] = None
+        if ann:
+            path_ivf, path_unit = os.path.join(store_dir, STORE_IVF), self._store_paths(store_dir)[2]
+            if os.path.exists(path_ivf) and os.path.exists(path_unit) and os.path.getmtime(path_ivf) >= os.path.getmtime(path_unit):
+                self.ann = IndexIVF.carregar(path_ivf, n_sondes)
+            else:
+                print(f"[FlavorGraph]: No hi ha índex IVF al dia a {store_dir}; s'usa la cerca exacta")
+
+    # --- STORE PRECOMPILAT (.npy + índex de noms) ---
+
+    @staticmethod
+    def _store_paths(store_dir: str) -> Tuple[str, str, str]:
+        return tuple(os.path.join(store_dir, f) for f in (STORE_MATRIX, STORE_NAMES, STORE_UNIT))
+
+    def _store_al_dia(self, store_dir: str, model_path: str, nodes_path: str) -> bool:
+        """El store existeix i no és més antic que el pickle ni el CSV de nodes."""
+        paths = self._store_paths(store_dir)[:2]
+        if not all(os.path.exists(p) for p in paths):
+            return False
+        t_store = min(os.path.getmtime(p) for p in paths)
+        return all(not os.path.exists(src) or os.path.getmtime(src) <= t_store for src in (model_path, nodes_path))
+
+    def _load_store(self, store_dir: str) -> Tuple[List[str], np.ndarray, Optional[np.ndarray]]:
+        """
+        Carrega el store en mode memory-map (només lectura, pàgines compartides entre processos).
+        La matriu unitària és None si falta o és anterior a la matriu (store d'una versió antiga).
+        """
+        path_matrix, path_names, path_unit = self._store_paths(store_dir)
+        with open(path_names, "r", encoding="utf-8") as f:
+            names = json.load(f)
+        matrix = np.load(path_matrix, mmap_mode="r").view(np.ndarray)
+        unit = None
+        if os.path.exists(path_unit) and os.path.getmtime(path_unit) >= os.path.getmtime(path_matrix):
+            unit = np.load(path_unit, mmap_mode="r").view(np.ndarray)
+        return names, matrix, unit
+
+    def _build_matrix(self, raw_embeddings: Dict, nodes_path: str) -> Tuple[List[str], np.ndarray]:
+        """Filtra els nodes del CSV i construeix la matriu float32 (ordre de primera aparició del nom)."""
+        import pandas as pd  # Només cal per construir el store des del pickle
+        df = pd.read_csv(nodes_path)
+        df.columns = [c.lower() for c in df.columns]
+        node_types = df['type'].map(lambda t: str(t).lower()) if 'type' in df.columns else [""] * len(df)
+
+        vectors: Dict[str, np.ndarray] = {}
+        for node_id, name, node_type in zip(df['node_id'].map(str), df['name'].map(str), node_types):
             # Filtre de qualitat: descartem compostos químics purs o IDs numèrics estranys
             is_chemical = 'compound' in node_type or (any(c.isdigit() for c in name) and len(name) > 10)
 
-            if node_id in self.raw_embeddings and not is_chemical:
+            if node_id in raw_embeddings and not is_chemical:
                 normalized_name = self._normalize_term(name)
                 if normalized_name:
-                    self.name_to_vector[normalized_name] = self.raw_embeddings[node_id]
-                    self.valid_ingredients.add(normalized_name)
+                    vectors[normalized_name] = raw_embeddings[node_id]
 
-        # Preparem la cache per a cerques ràpides
-        self._prepare_cache()
+        names = list(vectors.keys())
+        matrix = np.array(list(vectors.values()), dtype=np.float32) if names else np.empty((0, 0), dtype=np.float32)
+        return names, matrix
+
+    def _unit_matrix(self, names: List[str], matrix: np.ndarray) -> np.ndarray:
+        """Files normalitzades (float32); els noms no elegibles o de norma zero queden a NaN."""
+        if not names:
+            return np.empty((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1)
+        elegible = (norms > 0) & np.array([len(name) < self.MAX_NAME_LEN for name in names])
+        unit = np.full(matrix.shape, np.nan, dtype=np.float32)
+        unit[elegible] = matrix[elegible] / norms[elegible, None]
+        return unit
 
-    def _prepare_cache(self):
+    def _save_store(self, store_dir: str, names: List[str], matrix: np.ndarray, unit: np.ndarray) -> None:
+        """Escriptura atòmica del store (.npy contigus + índex de noms)."""
+        path_matrix, path_names, path_unit = self._store_paths(store_dir)
+        tmp_matrix, tmp_names, tmp_unit = path_matrix + ".tmp.npy", path_names + ".tmp", path_unit + ".tmp.npy"
+        np.save(tmp_matrix, np.ascontiguousarray(matrix, dtype=np.float32))
+        np.save(tmp_unit, np.ascontiguousarray(unit, dtype=np.float32))
+        with open(tmp_names, "w", encoding="utf-8") as f:
+            json.dump(names, f, ensure_ascii=False)
+        os.replace(tmp_matrix, path_matrix)
+        os.replace(tmp_names, path_names)
+        os.replace(tmp_unit, path_unit)
+
+    @classmethod
+    def build_store(cls, model_path: str = "models/FlavorGraph_Node_Embedding.pickle", nodes_path: str = "models/nodes_191120.csv",
+                    store_dir: Optional[str] = None) -> Tuple[str, str, str]:
+        """Pas de build únic: pickle + CSV -> matrius float32 (.npy, crua i unitària) + índex de noms (.json)."""
+        store_dir = store_dir if store_dir is not None else os.path.dirname(model_path)
+        wrapper = cls.__new__(cls)
+        with open(model_path, "rb") as f:
+            names, matrix = wrapper._build_matrix(pickle.load(f), nodes_path)
+        wrapper._save_store(store_dir, names, matrix, wrapper._unit_matrix(names, matrix))
+        return cls._store_paths(store_dir)
+
+    def build_ann_index(self, n_llistes: Optional[int] = None, n_sondes: int = 8) -> IndexIVF:
+        """Construeix l'índex IVF sobre la matriu unitària, el desa al store i l'activa."""
+        unit = self.cached_unit
+        if unit is None:  # Mode compacte: matriu unitària temporal només per construir
+            unit = self.cached_matrix.astype(np.float32) * self._inv_norms[:, None]
+        self.ann = IndexIVF.construir(unit, n_llistes=n_llistes, n_sondes=n_sondes)
+        try:
+            self.ann.desar(os.path.join(self.store_dir, STORE_IVF))
+        except OSError:
+            print(f"[FlavorGraph]: No s'ha pogut desar l'índex IVF a {self.store_dir}")
+        return self.ann
+
+    def _prepare_cache(self, names: Optional[List[str]] = None, matrix: Optional[np.ndarray] = None,
+                       unit: Optional[np.ndarray] = None):
             """Crea matrius NumPy estàtiques per càlcul vectorial massiu (eficiència)."""
-            self.cached_names = list(self.name_to_vector.keys())
+            if names is None:
+                names = list(self.name_to_vector.keys())
+                matrix = np.array(list(self.name_to_vector.values()), dtype=np.float32) if names else None
+            self.cached_names = names
+            self._inv_norms = None
             if not self.cached_names:
-                self.cached_matrix, self.cached_norms = np.empty((0, 0)), np.array([])
+                self.cached_matrix, self.cached_unit = np.empty((0, 0)), np.empty((0, 0))
+            elif getattr(self, "compact", False):
+                # Inverses de norma (NaN per als no elegibles) en lloc d'una segona matriu
+                self.cached_matrix, self.cached_unit = matrix, None
+                norms = np.sqrt(np.einsum("ij,ij->i", matrix, matrix, dtype=np.float32))
+                elegible = (norms > 0) & np.array([len(name) < self.MAX_NAME_LEN for name in names])
+                self._inv_norms = np.full(len(names), np.nan, dtype=np.float32)
+                self._inv_norms[elegible] = 1.0 / norms[elegible]
             else:
-                self.cached_matrix = np.array(list(self.name_to_vector.values()))
-                self.cached_norms = np.linalg.norm(self.cached_matrix, axis=1)
+                self.cached_matrix = matrix
+                self.cached_unit = unit if unit is not None else self._unit_matrix(names, matrix)
+
+    def elegibles(self) -> np.ndarray:
+        """Màscara dels nodes que poden sortir com a candidats a les cerques de veïns."""
+        if self.cached_unit is None:
+            return ~np.isnan(self._inv_norms)
+        return ~np.isnan(self.cached_unit).any(axis=1)
+
+    def memoria(self) -> Dict[str, float]:
+        """Memòria (MB) de les matrius del wrapper i memòria resident del procés."""
+        mb = 1 / 2 ** 20
+        info = {
+            nom: arr.nbytes * mb
+            for nom, arr in (("matriu", self.cached_matrix), ("unitaria", self.cached_unit), ("inv_normes", self._inv_norms))
+            if arr is not None
+        }
+        info["raw_embeddings"] = sum(getattr(v, "nbytes", 0) for v in (self.raw_embeddings or {}).values()) * mb
+        info["resident_proces"] = _resident_bytes() * mb
+        info["mmap"] = self.mmap  # Les matrius en mmap només ocupen les pàgines llegides i es comparteixen
+        return info
     
     def _normalize_term(self, text: str):
             """Neteja strings per garantir coincidències (ASCII, lowercase)."""
@@ -63,22 +276,96 @@ class FlavorGraphWrapper:
             text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii")
             return " ".join(text.replace("-", " ").replace("_", " ").lower().split())
 
-    def get_vector(self, ingredient_name: str) -> Optional[np.ndarray]:
-        """Recupera el vector associat a un ingredient (cerca directa, aliàs o parcial)."""
-        term = self._normalize_term(ingredient_name)
-        if not term: return None
-        
-        # 1Cerca exacta o per aliàs
-        if term in self.name_to_vector: return self.name_to_vector[term]
+    # --- RESOLUCIÓ DE NOMS (índexs construïts a la càrrega) ---
+
+    def _build_name_index(self):
+        """
+        Índexs per resoldre noms parcials sense recórrer tot el vocabulari:
+        - token -> primer nom (en ordre) que conté el token com a paraula,
+        - n-grama (3 caràcters) -> llista ordenada dels noms que el contenen,
+        - subcadenes curtes (1-2 caràcters) -> primer nom que les conté.
+        """
+        self._token_index: Dict[str, int] = {}
+        self._ngram_index = {}
+        self._short_index: Dict[str, int] = {}
+        for i, name in enumerate(self.cached_names):
+            for token in name.split():
+                self._token_index.setdefault(token, i)
+            for g in {name[j:j + 3] for j in range(len(name) - 2)}:
+                self._ngram_index.setdefault(g, []).append(i)
+            for mida in (1, 2):
+                for j in range(len(name) - mida + 1):
+                    self._short_index.setdefault(name[j:j + mida], i)
+
+    def _resolve_partial(self, term: str) -> Optional[int]:
+        """
+        Primer nom (en ordre del vocabulari) que conté 'term', igual que el recorregut lineal original.
+        Els n-grames donen els candidats (llista més curta); el token (si n'hi ha) fita on cal deixar de buscar.
+        """
+        if self._ngram_index is None:
+            self._build_name_index()
+        if len(term) < 3:
+            return self._short_index.get(term)
+
+        fita = self._token_index.get(term, len(self.cached_names))
+        grams = {term[j:j + 3] for j in range(len(term) - 2)}
+        if any(g not in self._ngram_index for g in grams):
+            return None
+        # Es recorre la llista més curta (ordenada) verificant la subcadena
+        for i in min((self._ngram_index[g] for g in grams), key=len):
+            if i >= fita:
+                break
+            if term in self.cached_names[i]:
+                return i
+        return fita if fita < len(self.cached_names) else None
+
+    def _resolve(self, term: str) -> Optional[int]:
+        """Índex del node per a un terme normalitzat (exacte, aliàs, singular o parcial)."""
+        if term in self._name_to_idx: return self._name_to_idx[term]
         if term in self.alias_map:
             alias = self._normalize_term(self.alias_map[term])
-            if alias in self.name_to_vector: return self.name_to_vector[alias]
-            
+            if alias in self._name_to_idx: return self._name_to_idx[alias]
+
         # Heurístiques simples (singulars, substrings)
-        if term.endswith("s") and term[:-1] in self.name_to_vector: return self.name_to_vector[term[:-1]]
-        for name, vector in self.name_to_vector.items():
-            if term == name or term in name.split() or term in name: return vector
-        return None
+        if term.endswith("s") and term[:-1] in self._name_to_idx: return self._name_to_idx[term[:-1]]
+        return self._resolve_partial(term)
+
+    def _resolve_cached(self, ingredient_name: str) -> Optional[int]:
+        """Resolució amb cache LRU: evita repetir la normalització i les cerques parcials."""
+        if ingredient_name in self._cache_noms:
+            self._cache_noms.move_to_end(ingredient_name)
+            self.cache_hits += 1
+            return self._cache_noms[ingredient_name]
+
+        self.cache_misses += 1
+        term = self._normalize_term(ingredient_name)
+        idx = self._resolve(term) if term else None
+        if self.mida_cache > 0:
+            self._cache_noms[ingredient_name] = idx
+            if len(self._cache_noms) > self.mida_cache:
+                self._cache_noms.popitem(last=False)
+        return idx
+
+    def estadistiques_cache(self) -> Dict[str, float]:
+        """Comptadors d'encerts/errades de la cache de resolució de noms."""
+        total = self.cache_hits + self.cache_misses
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "entrades": len(self._cache_noms),
+            "taxa_encert": self.cache_hits / total if total else 0.0,
+        }
+
+    def _resolve_name(self, ingredient_name: str) -> Optional[int]:
+        """Fila de la matriu per a un nom d'ingredient (None si no es resol)."""
+        if not isinstance(ingredient_name, str):
+            ingredient_name = str(ingredient_name) if ingredient_name else ""
+        return self._resolve_cached(ingredient_name)
+
+    def get_vector(self, ingredient_name: str) -> Optional[np.ndarray]:
+        """Recupera el vector associat a un ingredient (cerca directa, aliàs o parcial)."""
+        idx = self._resolve_name(ingredient_name)
+        return self.name_to_vector[self.cached_names[idx]] if idx is not None else None
 
     def _normalize_vector(self, vector: np.ndarray) -> Optional[np.ndarray]:
         if vector is None: return None
@@ -98,6 +385,30 @@ class FlavorGraphWrapper:
         base_vec = self._normalize_vector(self.get_vector(ingredient_name))
         if base_vec is None: return []
 
+        search_vec, temperature = self._creative_search_vector(base_vec, temperature, style_vector)
+        window_size = max(n * 2, int(n * (1 + temperature * 3)))
+        pool = self._find_nearest_to_vector(search_vec, n=window_size, exclude_names=[ingredient_name])
+        return self._sample_pool(pool, n, temperature)
+
+    def get_creative_candidates_batch(self, ingredient_names: List[str], n: int = 10, temperature: float = 0.0,
+                                      style_vector: Optional[np.ndarray] = None) -> List[List[Tuple[str, float]]]:
+        """
+        Mateix resultat que cridar get_creative_candidates per a cada ingredient (en ordre, amb el
+        mateix consum dels generadors aleatoris), però amb una sola cerca de veïns per lot.
+        """
+        queries = []
+        for name in ingredient_names:
+            base_vec = self._normalize_vector(self.get_vector(name))
+            queries.append(self._creative_search_vector(base_vec, temperature, style_vector)[0] if base_vec is not None else None)
+
+        temp = np.clip(temperature, 0.0, 1.0)
+        window_size = max(n * 2, int(n * (1 + temp * 3)))
+        pools = self.find_nearest_batch(queries, window_size, [[name] for name in ingredient_names])
+        return [self._sample_pool(pool, n, temp) if q is not None else [] for q, pool in zip(queries, pools)]
+
+    def _creative_search_vector(self, base_vec: np.ndarray, temperature: float,
+                                style_vector: Optional[np.ndarray]) -> Tuple[np.ndarray, float]:
+        """Vector de cerca creativa (steering cap a l'estil + soroll) i temperatura efectiva."""
         # Vector Steering: Modificar direcció cap a un estil (ex: "fer-ho picant")
         search_vec = base_vec.copy()
         if style_vector is not None:
@@ -115,11 +426,10 @@ class FlavorGraphWrapper:
             noised = self._normalize_vector(search_vec + noise)
             if noised is not None:
                 search_vec = noised
+        return search_vec, temperature
 
-        # Recuperació i mostreig
-        window_size = max(n * 2, int(n * (1 + temperature * 3)))
-        pool = self._find_nearest_to_vector(search_vec, n=window_size, exclude_names=[ingredient_name])
-        
+    def _sample_pool(self, pool: List[Tuple[str, float]], n: int, temperature: float) -> List[Tuple[str, float]]:
+        """Mostreig dels candidats recuperats segons la temperatura."""
         if temperature < 0.1: return pool[:n] # Determinista
 
         # Mostreig estocàstic triangular (prioritza millors scores però permet varietat)
@@ -154,29 +464,169 @@ class FlavorGraphWrapper:
         return [p for p in pool if p[0] not in excludes][:n]
 
     def _find_nearest_to_vector(self, target_vector: np.ndarray, n: int, exclude_names: List[str]) -> List[Tuple[str, float]]:
-        """Nucli matemàtic: Càlcul de similitud cosinus vectoritzat."""
+        """Nucli matemàtic: Càlcul de similitud cosinus vectoritzat (un matvec + partició O(V))."""
         if target_vector is None: return []
         if not hasattr(self, 'cached_matrix'): self._prepare_cache()
+        target = self._normalize_vector(np.asarray(target_vector, dtype=float))
+        if target is None or not self.cached_names: return []
 
-        # Dot product massiu
-        sims = np.dot(self.cached_matrix, target_vector) / (self.cached_norms * np.linalg.norm(target_vector))
-        sorted_idxs = sims.argsort()[::-1]
-        
-        results, count = [], 0
-        for idx in sorted_idxs:
-            name, score = self.cached_names[idx], float(sims[idx])
-            if name not in exclude_names and score < 0.999 and len(name) < 25:
-                results.append((name, score))
-                count += 1
-                if count >= n: break
+        if self.ann is not None:
+            # Cerca aproximada: només es puntuen les files de les llistes IVF més properes
+            files = self.ann.candidats(target)
+            return self._top_n(self._similarities(target, files), n, exclude_names, files)
+
+        # Dot product massiu (files NaN = no elegibles)
+        return self._top_n(self._similarities(target), n, exclude_names)
+
+    def _similarities(self, targets: np.ndarray, files: Optional[np.ndarray] = None) -> np.ndarray:
+        """Cosinus de consultes unitàries (D o Q x D) amb tots els nodes o amb 'files'; NaN = no elegible."""
+        if self.cached_unit is not None:
+            unit = self.cached_unit if files is None else self.cached_unit[files]
+            return targets.astype(unit.dtype) @ unit.T
+
+        # Mode compacte: producte amb la matriu crua i escalat per la inversa de la norma
+        matrix = self.cached_matrix if files is None else self.cached_matrix[files]
+        inv_norms = self._inv_norms if files is None else self._inv_norms[files]
+        targets = targets.astype(np.float32)
+        if matrix.dtype == np.float32:
+            return (targets @ matrix.T) * inv_norms
+        sims = np.empty(targets.shape[:-1] + (len(matrix),), dtype=np.float32)
+        for i in range(0, len(matrix), self.COMPACT_BLOCK):  # float16 -> float32 per blocs (sense còpia completa)
+            sims[..., i:i + self.COMPACT_BLOCK] = targets @ matrix[i:i + self.COMPACT_BLOCK].astype(np.float32).T
+        return sims * inv_norms
+
+    def find_nearest_batch(self, vectors: List[Optional[np.ndarray]], n: int,
+                           exclude_per_query: Optional[List[List[str]]] = None) -> List[List[Tuple[str, float]]]:
+        """
+        Veïns més propers per a Q vectors amb un sol producte matriu-matriu (Q x D · D x V).
+        Retorna, per a cada consulta, el mateix que _find_nearest_to_vector ([] si el vector és None o nul),
+        també amb l'índex IVF actiu.
+        """
+        if exclude_per_query is None: exclude_per_query = [[] for _ in vectors]
+        if not hasattr(self, 'cached_matrix'): self._prepare_cache()
+        results = [[] for _ in vectors]
+        if not self.cached_names: return results
+
+        valid, targets = [], []
+        for q, vector in enumerate(vectors):
+            target = self._normalize_vector(np.asarray(vector, dtype=float)) if vector is not None else None
+            if target is not None:
+                valid.append(q)
+                targets.append(target)
+        if not valid: return results
+
+        if self.ann is not None:
+            # Cerca aproximada: un sol producte sobre la unió de les files IVF de totes les consultes,
+            # i cada consulta només es puntua sobre les seves pròpies files candidates
+            files_per_query = [self.ann.candidats(target) for target in targets]
+            unio = np.unique(np.concatenate(files_per_query))
+            sims = self._similarities(np.vstack(targets), unio)
+            for fila, (q, files) in enumerate(zip(valid, files_per_query)):
+                results[q] = self._top_n(sims[fila, np.searchsorted(unio, files)], n, exclude_per_query[q], files)
+            return results
+
+        sims = self._similarities(np.vstack(targets))
+        for fila, q in enumerate(valid):
+            results[q] = self._top_n(sims[fila], n, exclude_per_query[q])
         return results
 
+    def _top_n(self, sims: np.ndarray, n: int, exclude_names: List[str], files: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """
+        Top-n amb np.argpartition després d'emmascarar no elegibles, quasi-idèntics i exclosos.
+        'files' indica a quin node correspon cada posició de 'sims' (per defecte, tots en ordre).
+        """
+        sims = np.where(sims < self.MAX_SIMILARITY, sims, -np.inf)  # NaN també queda fora
+        exclosos = [self._name_to_idx[x] for x in (exclude_names or []) if x in self._name_to_idx]
+        if files is None:
+            sims[exclosos] = -np.inf
+        elif exclosos:
+            sims[np.isin(files, exclosos)] = -np.inf
+
+        k = min(n, len(sims))
+        if k <= 0: return []
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top], kind="stable")]
+        nodes = top if files is None else files[top]
+        return [(self.cached_names[j], float(sims[i])) for i, j in zip(top, nodes) if sims[i] > -np.inf]
+
     def similarity_with_vector(self, ingredient_name: str, target_vector: np.ndarray) -> Optional[float]:
         """Calcula distància semàntica entre un ingredient i un concepte."""
         v1, v2 = self._normalize_vector(self.get_vector(ingredient_name)), self._normalize_vector(target_vector)
         return float(np.dot(v1, v2)) if v1 is not None and v2 is not None else None
     
+    def similarity_matrix(self, ingredient_names: List[str], target_vectors: List[Optional[np.ndarray]]) -> np.ndarray:
+        """
+        Similituds cosinus de C ingredients amb T vectors en un sol producte (C x D · D x T).
+        Cada cel·la equival a similarity_with_vector; hi ha NaN on aquella retornaria None.
+        """
+        sims = np.full((len(ingredient_names), len(target_vectors)), np.nan)
+        files = [self._resolve_name(name) for name in ingredient_names]
+        pos = [p for p, f in enumerate(files) if f is not None]
+        targets = [(c, self._normalize_vector(t)) for c, t in enumerate(target_vectors)]
+        targets = [(c, t) for c, t in targets if t is not None]
+        if not pos or not targets:
+            return sims
+
+        rows = np.asarray(self.cached_matrix[[files[p] for p in pos]], dtype=np.float32)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rows = rows / np.linalg.norm(rows, axis=1)[:, None]  # Norma zero -> NaN (com None)
+        sims[np.ix_(pos, [c for c, _ in targets])] = rows @ np.column_stack([t for _, t in targets])
+        return sims
+
     def compute_concept_vector(self, ingredient_names: List[str]) -> Optional[np.ndarray]:
         """Genera el vector 'centre de masses' d'una llista d'ingredients (defineix un Estil/Concepte)."""
         vectors = [v for name in ingredient_names if (v := self.get_vector(name)) is not None]
-        return np.mean(vectors, axis=0) if vectors else None
\ No newline at end of file
+        return np.mean(vectors, axis=0) if vectors else None
+
+
+class LazyFlavorGraphWrapper:
+    """
+    Proxy del FlavorGraphWrapper que no carrega res fins al primer accés a un atribut.
+    Així importar els operadors no paga la càrrega dels embeddings si no s'usen.
+    prefetch() avança la càrrega en un fil en segon pla (p.ex. mentre l'usuari respon).
+    """
+    _PROPIS = ("_args", "_kwargs", "_wrapper", "_lock", "_fil")
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, "_args", args)
+        object.__setattr__(self, "_kwargs", kwargs)
+        object.__setattr__(self, "_wrapper", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+        object.__setattr__(self, "_fil", None)
+
+    @property
+    def carregat(self) -> bool:
+        return self._wrapper is not None
+
+    def carregar(self) -> FlavorGraphWrapper:
+        """Instància real (es construeix una sola vegada, també amb diversos fils)."""
+        if self._wrapper is None:
+            with self._lock:
+                if self._wrapper is None:
+                    object.__setattr__(self, "_wrapper", FlavorGraphWrapper(*self._args, **self._kwargs))
+        return self._wrapper
+
+    def prefetch(self) -> Optional[threading.Thread]:
+        """Comença la càrrega en un fil daemon; els errors es tornaran a produir al primer ús real."""
+        if self._wrapper is None and self._fil is None:
+            def _carregar():
+                try:
+                    self.carregar()
+                except Exception:
+                    pass
+            object.__setattr__(self, "_fil", threading.Thread(target=_carregar, name="flavorgraph-prefetch", daemon=True))
+            self._fil.start()
+        return self._fil
+
+    def __getattr__(self, nom: str):
+        if nom in LazyFlavorGraphWrapper._PROPIS:
+            raise AttributeError(nom)
+        return getattr(self.carregar(), nom)
+
+    def __setattr__(self, nom: str, valor: Any) -> None:
+        setattr(self.carregar(), nom, valor)
+
+
+if __name__ == "__main__":
+    paths = FlavorGraphWrapper.build_store(*sys.argv[1:4])
+    print(f"[FlavorGraph]: Store generat a {paths[0]} i {paths[1]}")
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import numpy as np
+from typing import Dict, List, Optional
+"""
+ÍNDEX APROXIMAT DE VEÏNS (IVF)
+------------------------------
+Índex de fitxers invertits per a la matriu unitària de FlavorGraph:
+1. Un quantitzador groller (k-means esfèric) reparteix els nodes en llistes.
+2. Cada consulta només puntua els nodes de les n_sondes llistes amb el centroide més proper.
+Es construeix offline, es desa al costat dels embeddings (.npz) i s'avalua amb
+recall@n contra la cerca exacta.
+    python src/index_ivf.py [directori_store] [n_llistes] [n_sondes]
+"""
+
+class IndexIVF:
+    def __init__(self, centroides: np.ndarray, ordre: np.ndarray, offsets: np.ndarray, n_sondes: int = 8):
+        self.centroides = centroides    # L x D (unitaris)
+        self.ordre = ordre              # Files de la matriu agrupades per llista
+        self.offsets = offsets          # Llista l -> ordre[offsets[l]:offsets[l + 1]]
+        self.n_sondes = n_sondes
+
+    @property
+    def n_llistes(self) -> int:
+        return len(self.centroides)
+
+    # --- CONSTRUCCIÓ (k-means esfèric) ---
+
+    @classmethod
+    def construir(cls, unit: np.ndarray, n_llistes: Optional[int] = None, n_sondes: int = 8,
+                  iteracions: int = 15, seed: int = 0) -> "IndexIVF":
+        """Agrupa les files vàlides (no NaN) de la matriu unitària en n_llistes llistes."""
+        files = np.flatnonzero(~np.isnan(unit).any(axis=1))
+        X = np.asarray(unit[files], dtype=np.float32)
+        if n_llistes is None:
+            n_llistes = max(1, int(np.sqrt(len(files))))
+        n_llistes = max(1, min(n_llistes, len(files)))
+
+        rng = np.random.default_rng(seed)
+        centroides = X[rng.choice(len(X), n_llistes, replace=False)].copy()
+        for _ in range(iteracions):
+            assignacio = cls._assignar(X, centroides)
+            sumes = np.zeros_like(centroides)
+            np.add.at(sumes, assignacio, X)
+            normes = np.linalg.norm(sumes, axis=1)
+            buides = normes == 0
+            centroides[~buides] = sumes[~buides] / normes[~buides, None]
+            # Les llistes buides es reinicialitzen amb nodes a l'atzar
+            if buides.any():
+                centroides[buides] = X[rng.choice(len(X), int(buides.sum()), replace=False)]
+
+        assignacio = cls._assignar(X, centroides)
+        ordre_local = np.argsort(assignacio, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignacio, minlength=n_llistes))])
+        return cls(centroides, files[ordre_local], offsets, n_sondes)
+
+    @staticmethod
+    def _assignar(X: np.ndarray, centroides: np.ndarray, bloc: int = 65536) -> np.ndarray:
+        """Centroide més proper (producte escalar) per blocs de files."""
+        return np.concatenate([np.argmax(X[i:i + bloc] @ centroides.T, axis=1) for i in range(0, len(X), bloc)])
+
+    # --- CONSULTA ---
+
+    def candidats(self, target: np.ndarray, n_sondes: Optional[int] = None) -> np.ndarray:
+        """Files de la matriu dins les n_sondes llistes més properes al vector (unitari) de consulta."""
+        n_sondes = min(n_sondes or self.n_sondes, self.n_llistes)
+        scores = self.centroides @ target.astype(self.centroides.dtype)
+        llistes = np.argpartition(-scores, n_sondes - 1)[:n_sondes]
+        return np.concatenate([self.ordre[self.offsets[l]:self.offsets[l + 1]] for l in llistes])
+
+    # --- PERSISTÈNCIA ---
+
+    def desar(self, path: str) -> None:
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, centroides=self.centroides, ordre=self.ordre, offsets=self.offsets)
+        os.replace(tmp, path)
+
+    @classmethod
+    def carregar(cls, path: str, n_sondes: int = 8) -> "IndexIVF":
+        with np.load(path) as dades:
+            return cls(dades["centroides"], dades["ordre"], dades["offsets"], n_sondes)
+
+
+def avaluar_recall(wrapper, index: IndexIVF, n: int = 10, n_consultes: int = 200, seed: int = 0) -> Dict[str, float]:
+    """
+    Benchmark recall@n de l'índex contra la cerca exacta del wrapper, amb nodes reals com a consultes.
+    Retorna el recall mitjà i la latència mitjana (ms) de cada camí.
+    """
+    rng = np.random.default_rng(seed)
+    valides = np.flatnonzero(wrapper.elegibles())
+    consultes: List[int] = rng.choice(valides, min(n_consultes, len(valides)), replace=False).tolist()
+
+    anterior = wrapper.ann
+    recalls, t_exacte, t_ivf = [], 0.0, 0.0
+    try:
+        for fila in consultes:
+            vector = wrapper.cached_matrix[fila]
+            wrapper.ann = None
+            t = time.perf_counter()
+            exacte = {nom for nom, _ in wrapper._find_nearest_to_vector(vector, n, [])}
+            t_exacte += time.perf_counter() - t
+
+            wrapper.ann = index
+            t = time.perf_counter()
+            aprox = {nom for nom, _ in wrapper._find_nearest_to_vector(vector, n, [])}
+            t_ivf += time.perf_counter() - t
+            if exacte:
+                recalls.append(len(exacte & aprox) / len(exacte))
+    finally:
+        wrapper.ann = anterior
+
+    return {
+        f"recall@{n}": float(np.mean(recalls)) if recalls else 0.0,
+        "ms_exacte": 1000 * t_exacte / max(1, len(consultes)),
+        "ms_ivf": 1000 * t_ivf / max(1, len(consultes)),
+    }
+
+
+if __name__ == "__main__":
+    from flavorgraph_embeddings import FlavorGraphWrapper
+
+    store_dir = sys.argv[1] if len(sys.argv) > 1 else "models"
+    n_llistes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    n_sondes = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    fg = FlavorGraphWrapper(model_path=os.path.join(store_dir, "FlavorGraph_Node_Embedding.pickle"),
+                            nodes_path=os.path.join(store_dir, "nodes_191120.csv"), store_dir=store_dir)
+    index = fg.build_ann_index(n_llistes=n_llistes, n_sondes=n_sondes)
+    print(f"[IVF]: {index.n_llistes} llistes, {n_sondes} sondes")
+    for n in (5, 10, 30):
+        print(f"[IVF]: {avaluar_recall(fg, index, n=n)}")
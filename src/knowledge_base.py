@@ -1,8 +1,11 @@
 import csv
+import hashlib
 import json
 import os
+import pickle
 import unicodedata
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+import numpy as np
 
 """
 BASE DE CONEIXEMENT (Singleton)
@@ -11,8 +14,34 @@ Gestiona la càrrega de dades des de CSV/JSON i ofereix consultes normalitzades.
 Actua com a Single Source of Truth per a tot el sistema CBR.
 """
 
+class FitxaIngredient(dict):
+    """
+    Fitxa immutable d'un ingredient: columnes del CSV + camps canònics
+    (ingredient_name, macro_category, family). És un dict de només lectura:
+    les lectures (get, []) van a velocitat de dict i les escriptures es bloquegen.
+    """
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FitxaIngredient és immutable")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    update = pop = popitem = setdefault = clear = _immutable
+
+    def __reduce__(self):
+        return (FitxaIngredient, (dict(self),))
+
+    def __repr__(self) -> str:
+        return f"FitxaIngredient({dict.__repr__(self)})"
+
+
 class KnowledgeBase:
     _instance = None
+    # Snapshot binari de la KB ja indexada (es regenera si canvia alguna font o la versió)
+    SNAPSHOT = "kb_snapshot.pkl"
+    VERSIO_SNAPSHOT = 3
+    _MAGIC_SNAPSHOT = b"KBSNAP"
+    FONTS = ("ingredients_en.csv", "estils.csv", "tecniques.csv", "begudes_en.csv", "estils_latents.json")
 
     def __new__(cls):
         if cls._instance is None:
@@ -31,15 +60,83 @@ class KnowledgeBase:
         self.begudes: Dict[str, Dict] = {}
         self.estils_latents: Dict = {}
 
-        # Càrrega massiva de dades
-        self._carregar_ingredients()
-        self._carregar_generic("estils.csv", self.estils, "nom_estil")
-        self._carregar_generic("tecniques.csv", self.tecniques, "nom_tecnica")
-        self._carregar_generic("begudes_en.csv", self.begudes, ["id", "nom"])
-        self._carregar_latents()
+        # Càrrega massiva de dades (des del snapshot si està al dia)
+        if not self._carregar_snapshot():
+            self._carregar_ingredients()
+            self._carregar_generic("estils.csv", self.estils, "nom_estil")
+            self._carregar_generic("tecniques.csv", self.tecniques, "nom_tecnica")
+            self._carregar_generic("begudes_en.csv", self.begudes, ["id", "nom"])
+            self._carregar_latents()
+            self._desar_snapshot()
+        # Depenen de les heurístiques dels operadors: es construeixen sota demanda (fora del snapshot)
+        self._mascares_compatibilitat = None
 
         self._inicialitzat = True
 
+    # SNAPSHOT BINARI
+    # Format: MAGIC + sha256(payload) + payload, amb payload = pickle((versió, clau de fonts, estat)).
+    _CAMPS_SNAPSHOT = (
+        "ingredients", "estils", "tecniques", "begudes", "estils_latents", "_mtime_latents",
+        "_fitxes_ingredients", "_posicio_ingredient", "_idx_categoria",
+    )
+
+    def _clau_fonts(self) -> Tuple:
+        """(fitxer, mtime_ns, mida) de cada font; None si el fitxer no existeix."""
+        clau = []
+        for nom in self.FONTS:
+            try:
+                st = os.stat(os.path.join(self.data_dir, nom))
+                clau.append((nom, st.st_mtime_ns, st.st_size))
+            except OSError:
+                clau.append((nom, None, None))
+        return tuple(clau)
+
+    def _carregar_snapshot(self) -> bool:
+        """Restaura l'estat des del snapshot (una sola lectura). Retorna False si no hi és, és corrupte o no està al dia."""
+        if not self.SNAPSHOT:
+            return False
+        path = os.path.join(self.data_dir, self.SNAPSHOT)
+        try:
+            with open(path, "rb") as f:
+                dades = f.read()
+        except OSError:
+            return False
+
+        try:
+            n_magic = len(self._MAGIC_SNAPSHOT)
+            digest, payload = dades[n_magic:n_magic + 32], dades[n_magic + 32:]
+            if dades[:n_magic] != self._MAGIC_SNAPSHOT or hashlib.sha256(payload).digest() != digest:
+                print(f"[KnowledgeBase] Snapshot corrupte, es regenera: {self.SNAPSHOT}")
+                return False
+            versio, clau, estat = pickle.loads(payload)
+        except Exception as e:
+            print(f"[KnowledgeBase] Error llegint {self.SNAPSHOT}: {e}")
+            return False
+
+        if versio != self.VERSIO_SNAPSHOT or clau != self._clau_fonts():
+            return False
+        for camp in self._CAMPS_SNAPSHOT:
+            setattr(self, camp, estat[camp])
+        self._centroides_latents = None  # Depenen dels embeddings: es calculen sota demanda
+        return True
+
+    def _desar_snapshot(self) -> None:
+        """Escriu el snapshot de forma atòmica (tmp + os.replace)."""
+        if not self.SNAPSHOT or not os.path.isdir(self.data_dir):
+            return
+        path = os.path.join(self.data_dir, self.SNAPSHOT)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            estat = {camp: getattr(self, camp) for camp in self._CAMPS_SNAPSHOT}
+            payload = pickle.dumps((self.VERSIO_SNAPSHOT, self._clau_fonts(), estat), protocol=pickle.HIGHEST_PROTOCOL)
+            with open(tmp, "wb") as f:
+                f.write(self._MAGIC_SNAPSHOT + hashlib.sha256(payload).digest() + payload)
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"[KnowledgeBase] No s'ha pogut desar {self.SNAPSHOT}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
     def _normalize(self, text: str) -> str:
         """Normalitza text (ASCII, minúscules) per a claus de diccionari robustes."""
         if not text:
@@ -86,10 +183,48 @@ class KnowledgeBase:
         """Càrrega d'ingredients amb normalització de clau."""
         keys = ["nom_ingredient", "ingredient_name", "name"]
         self._carregar_csv("ingredients_en.csv", self.ingredients, keys, normalize_key=True)
+        self._construir_fitxes_ingredients()
+        self._indexar_ingredients()
+
+    def _construir_fitxes_ingredients(self) -> None:
+        """Normalitza cada fila un sol cop a una FitxaIngredient (get_info_ingredient la retorna sense còpia)."""
+        mappings = {
+            "ingredient_name": ["nom_ingredient", "name"],
+            "macro_category": ["categoria_macro"],
+            "family": ["familia"],
+        }
+        self._fitxes_ingredients: Dict[str, FitxaIngredient] = {}
+        for clau, row in self.ingredients.items():
+            out = dict(row)
+            for std_key, alt_keys in mappings.items():
+                if std_key in out and out.get(std_key):
+                    continue
+                out[std_key] = next((out.get(k) for k in alt_keys if out.get(k)), "")
+            self._fitxes_ingredients[clau] = FitxaIngredient(out)
+
+    def _indexar_ingredients(self) -> None:
+        """
+        Índex invertit (categoria macro normalitzada -> noms) i posició de cada ingredient al catàleg.
+        Es construeixen un sol cop a la càrrega.
+        """
+        self._posicio_ingredient: Dict[str, int] = {}
+        index: Dict[str, set] = {}
+        for row in self.ingredients.values():
+            nom = row.get("ingredient_name") or row.get("nom_ingredient") or row.get("name")
+            if not nom:
+                continue
+            self._posicio_ingredient.setdefault(nom, len(self._posicio_ingredient))
+            if clau := self._normalize(row.get("macro_category") or row.get("categoria_macro")):
+                index.setdefault(clau, set()).add(nom)
+
+        self._idx_categoria: Dict[str, FrozenSet[str]] = {clau: frozenset(noms) for clau, noms in index.items()}
 
     def _carregar_latents(self) -> None:
         """Carrega estils latents des de JSON si existeix."""
         path = os.path.join(self.data_dir, "estils_latents.json")
+        # Els centroides es recalculen (un cop) per a cada càrrega del JSON
+        self._centroides_latents: Optional[Dict[str, Tuple[Optional[np.ndarray], Optional[np.ndarray]]]] = None
+        self._mtime_latents = os.path.getmtime(path) if os.path.exists(path) else None
         if not os.path.exists(path):
             self.estils_latents = {}
             return
@@ -101,6 +236,37 @@ class KnowledgeBase:
             print(f"[KnowledgeBase] Error llegint estils_latents.json: {e}")
             self.estils_latents = {}
 
+    def _latents_al_dia(self) -> None:
+        """Recarrega estils_latents.json (i invalida els centroides) si el fitxer ha canviat."""
+        path = os.path.join(self.data_dir, "estils_latents.json")
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if mtime != self._mtime_latents:
+            self._carregar_latents()
+
+    def vector_estil_latent(self, nom_estil: str, normalitzat: bool = False) -> Optional[np.ndarray]:
+        """
+        Centroide (cru o unitari) dels ingredients d'un estil latent.
+        Es calculen tots els estils una sola vegada per càrrega del JSON; després és un accés a diccionari.
+        """
+        self._latents_al_dia()
+        if self._centroides_latents is None:
+            # Import diferit: evita el cicle amb els operadors i no carrega embeddings a l'arrencada
+            from operador_ingredients import FG_WRAPPER
+
+            centroides = {}
+            for nom, dades in self.estils_latents.items():
+                cru = FG_WRAPPER.compute_concept_vector((dades or {}).get("ingredients", []))
+                norma = float(np.linalg.norm(cru)) if cru is not None else 0.0
+                unitari = cru / norma if norma else None
+                for v in (cru, unitari):
+                    if v is not None:
+                        v.setflags(write=False)  # Compartits entre crides: només lectura
+                centroides[nom] = (cru, unitari)
+            self._centroides_latents = centroides
+
+        cru, unitari = self._centroides_latents.get(nom_estil, (None, None))
+        return unitari if normalitzat else cru
+
     # RETAIN (Integració CBR)
     def retain_case(
         self,
@@ -119,27 +285,13 @@ class KnowledgeBase:
         return retain_case_impl(self, new_case, evaluation_result, transformation_log, user_score, retriever_instance)
 
     # API DE CONSULTA (Getters)
-    def get_info_ingredient(self, nom: str) -> Optional[Dict]:
-        """Retorna metadades normalitzades d'un ingredient."""
-        row = self.ingredients.get(self._normalize(nom))
-        if not row:
-            return None
-
-        # Normalització de camps per garantir consistència al codi
-        out = row.copy()
-        mappings = {
-            "ingredient_name": ["nom_ingredient", "name"],
-            "macro_category": ["categoria_macro"],
-            "family": ["familia"],
-        }
-
-        for std_key, alt_keys in mappings.items():
-            if std_key in out and out.get(std_key):
-                continue
-            found = next((out.get(k) for k in alt_keys if out.get(k)), "")
-            out[std_key] = found
-
-        return out
+    def get_info_ingredient(self, nom: str) -> Optional[FitxaIngredient]:
+        """Retorna la fitxa normalitzada (immutable, compartida) d'un ingredient."""
+        # Els noms que ja són claus normalitzades no cal tornar-los a normalitzar
+        fitxa = self._fitxes_ingredients.get(nom)
+        if fitxa is None and nom:
+            fitxa = self._fitxes_ingredients.get(self._normalize(nom))
+        return fitxa
 
     def get_info_estil(self, nom_estil: str) -> Optional[Dict]:
         """Retorna metadades d'un estil (clau exacta)."""
@@ -149,6 +301,28 @@ class KnowledgeBase:
         """Retorna metadades d'una tècnica (clau exacta)."""
         return self.tecniques.get(nom_tecnica)
 
+    # CONSULTES INDEXADES D'INGREDIENTS (conjunts de noms)
+    def ingredients_per_categoria(self, categoria: str) -> FrozenSet[str]:
+        """Ingredients d'una categoria macro."""
+        return self._idx_categoria.get(self._normalize(categoria), frozenset())
+
+    def mascares_compatibilitat(self) -> Any:
+        """
+        Màscares de bits d'al·lèrgens, dietes i marcadors de risc de tot el catàleg.
+        Es construeixen un sol cop (al primer ús) i permeten compilar perfils a una màscara prohibida.
+        """
+        if self._mascares_compatibilitat is None:
+            # Import diferit: les heurístiques de compatibilitat viuen a l'operador d'ingredients
+            from operador_ingredients import MascaresCompatibilitat
+
+            self._mascares_compatibilitat = MascaresCompatibilitat(self)
+        return self._mascares_compatibilitat
+
+    def ordre_cataleg(self, noms: Iterable[str]) -> List[str]:
+        """Ordena un conjunt de noms segons l'ordre del catàleg (resultats deterministes)."""
+        posicio = self._posicio_ingredient
+        return sorted(noms, key=lambda nom: posicio.get(nom, len(posicio)))
+
     # HELPERS D'ESTILS I LATENTS
     def llista_estils_per_tipus(self, tipus: str) -> List[str]:
         """Llista estils filtrats per tipus (ex: 'cultural')."""
@@ -0,0 +1,316 @@
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+"""
+MAGATZEM DE LA BASE DE CASOS (Persistència)
+-------------------------------------------
+Emmagatzematge segmentat de la memòria episòdica del sistema CBR:
+1. Snapshot immutable (base_de_casos.json): estat consolidat de la BC.
+2. Registre append-only (base_de_casos.jsonl): un cas per línia amb els casos
+   apresos des de l'última compactació.
+Retenir un cas només costa un append; periòdicament el registre es compacta
+dins d'un snapshot nou (escriptura atòmica amb os.replace).
+
+Per a desplegaments multiusuari hi ha un backend SQLite opcional (MagatzemCasosSQLite)
+amb els atributs del problema en columnes indexades, que permet aplicar prefiltres en SQL.
+"""
+
+# Atributs del problema indexats (columna -> és numèrica)
+COLUMNES_PROBLEMA = {
+    "tipus_esdeveniment": False,
+    "servei": False,
+    "temporada": False,
+    "formalitat": False,
+    "n_comensals": True,
+    "preu_pers_objectiu": True,
+}
+EXTENSIONS_SQLITE = (".db", ".sqlite", ".sqlite3")
+
+
+def _norm_text(x: Any) -> str:
+    """Mateixa normalització que Retriever._norm."""
+    return str(x).strip().lower() if x else ""
+
+
+def _a_float(x: Any) -> Optional[float]:
+    try:
+        return float(x)
+    except (ValueError, TypeError):
+        return None
+
+
+def _valor_columna(problema: Dict, columna: str) -> Any:
+    """Valor normalitzat d'un atribut del problema tal com es desa a la columna indexada."""
+    if columna == "preu_pers_objectiu":
+        return _a_float(problema.get("preu_pers_objectiu", problema.get("preu_pers")))
+    if COLUMNES_PROBLEMA[columna]:
+        return _a_float(problema.get(columna))
+    return _norm_text(problema.get(columna))
+
+
+def _condicio(columna: str, valor: Any) -> Tuple[str, Any]:
+    """
+    Interpreta una entrada de prefiltre:
+    - columnes de text: cadena (igualtat) o iterable de cadenes (pertinença),
+    - columnes numèriques: número (igualtat) o tupla (min, max) amb None com a extrem obert.
+    """
+    if columna not in COLUMNES_PROBLEMA:
+        raise ValueError(f"Columna de prefiltre desconeguda: {columna}")
+    if COLUMNES_PROBLEMA[columna]:
+        if isinstance(valor, tuple):
+            return "rang", valor
+        if _a_float(valor) is None:
+            raise ValueError(f"Valor de prefiltre no numèric per a {columna}: {valor!r}")
+        return "igual", float(valor)
+    if valor is None or isinstance(valor, str):
+        return "igual", _norm_text(valor)  # None equival a l'atribut buit ("")
+    return "dins", {_norm_text(v) for v in valor}
+
+
+def compleix_prefiltre(cas: Dict, prefiltre: Dict[str, Any]) -> bool:
+    """Avaluació en Python del prefiltre (backends sense SQL)."""
+    problema = cas.get("problema", {}) or {}
+    for columna, valor in prefiltre.items():
+        tipus, arg = _condicio(columna, valor)
+        actual = _valor_columna(problema, columna)
+        if tipus == "igual" and actual != arg:
+            return False
+        if tipus == "dins" and actual not in arg:
+            return False
+        if tipus == "rang":
+            minim, maxim = arg
+            if actual is None or (minim is not None and actual < minim) or (maxim is not None and actual > maxim):
+                return False
+    return True
+
+
+def obrir_magatzem(path: str) -> Any:
+    """Tria el backend segons l'extensió: SQLite (.db/.sqlite/.sqlite3) o JSON + registre."""
+    if path.lower().endswith(EXTENSIONS_SQLITE):
+        return MagatzemCasosSQLite(path)
+    return MagatzemCasos(path)
+
+
+class MagatzemCasos:
+    def __init__(self, path_snapshot: str, path_log: Optional[str] = None, compactar_cada: int = 50):
+        self.path_snapshot = path_snapshot
+        self.path_log = path_log or os.path.splitext(path_snapshot)[0] + ".jsonl"
+        self.compactar_cada = compactar_cada
+        self._n_log: Optional[int] = None  # Entrades al registre (es calcula a la primera lectura)
+
+    # --- LECTURA ---
+
+    def _llegir_snapshot(self) -> List[Dict]:
+        if not os.path.exists(self.path_snapshot):
+            return []
+        try:
+            with open(self.path_snapshot, "r", encoding="utf-8") as f:
+                return json.load(f) or []
+        except (OSError, json.JSONDecodeError):
+            print(f"[MagatzemCasos]: No s'ha pogut carregar {self.path_snapshot}")
+            return []
+
+    def _llegir_log(self) -> List[Dict]:
+        """Llegeix el registre ignorant línies incompletes (escriptura interrompuda per una caiguda)."""
+        if not os.path.exists(self.path_log):
+            return []
+        casos = []
+        with open(self.path_log, "r", encoding="utf-8") as f:
+            for linia in f:
+                linia = linia.strip()
+                if not linia:
+                    continue
+                try:
+                    casos.append(json.loads(linia))
+                except json.JSONDecodeError:
+                    continue
+        return casos
+
+    def carregar(self) -> List[Dict]:
+        """Loader únic de la BC (Retriever i Retain): snapshot + casos del registre."""
+        casos = self._llegir_snapshot()
+        log = self._llegir_log()
+        self._n_log = len(log)
+
+        # Si una compactació es va interrompre després de fixar el snapshot,
+        # el registre encara conté casos ja consolidats: es descarten per id_cas.
+        ids = {c.get("id_cas") for c in casos if c.get("id_cas") is not None}
+        casos.extend(c for c in log if c.get("id_cas") is None or c.get("id_cas") not in ids)
+        return casos
+
+    # --- ESCRIPTURA ---
+
+    def afegir(self, cas: Dict[str, Any]) -> None:
+        """Afegeix un cas al registre amb un sol append (fsync inclòs)."""
+        linia = json.dumps(cas, ensure_ascii=False) + "\n"
+
+        # Si l'última escriptura va quedar a mitges, comencem en una línia nova
+        if os.path.exists(self.path_log) and os.path.getsize(self.path_log) > 0:
+            with open(self.path_log, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    linia = "\n" + linia
+
+        with open(self.path_log, "a", encoding="utf-8") as f:
+            f.write(linia)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self._n_log is None:
+            self._n_log = len(self._llegir_log())
+        else:
+            self._n_log += 1
+
+        if self.compactar_cada and self._n_log >= self.compactar_cada:
+            self.compactar()
+
+    def compactar(self) -> None:
+        """Consolida snapshot + registre en un snapshot nou i buida el registre."""
+        casos = self.carregar()
+        tmp = self.path_snapshot + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(casos, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path_snapshot)
+
+        # Només després de fixar el snapshot es buida el registre
+        with open(self.path_log, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._n_log = 0
+
+
+class MagatzemCasosSQLite:
+    """
+    Backend SQLite de la BC (mòdul estàndard sqlite3).
+    Els atributs del problema van a columnes indexades i problema/solucio/avaluacio a columnes JSON.
+    Diversos processos poden compartir el fitxer (mode WAL); cada Retriever incorpora
+    els casos que han afegit els altres amb casos_nous().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.con = sqlite3.connect(path, timeout=30)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS casos (
+                rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+                id_cas INTEGER,
+                tipus_esdeveniment TEXT, servei TEXT, temporada TEXT, formalitat TEXT,
+                n_comensals REAL, preu_pers_objectiu REAL,
+                problema TEXT, solucio TEXT, avaluacio TEXT, extra TEXT
+            )"""
+        )
+        for columna in ("id_cas",) + tuple(COLUMNES_PROBLEMA):
+            self.con.execute(f"CREATE INDEX IF NOT EXISTS idx_casos_{columna} ON casos({columna})")
+        self.con.commit()
+
+        self._ultim_rowid: Optional[int] = None  # Últim rowid incorporat a l'índex en memòria
+        self._rowids_propis = set()              # Files escrites per aquest procés (ja indexades pel Retain)
+
+    # --- CONVERSIÓ FILA <-> CAS ---
+
+    def _fila(self, cas: Dict) -> Tuple:
+        problema = cas.get("problema", {}) or {}
+        extra = {k: v for k, v in cas.items() if k not in ("id_cas", "problema", "solucio", "avaluacio")}
+        return (
+            cas.get("id_cas"),
+            *(_valor_columna(problema, c) for c in COLUMNES_PROBLEMA),
+            json.dumps(problema, ensure_ascii=False),
+            json.dumps(cas.get("solucio", {}), ensure_ascii=False),
+            json.dumps(cas.get("avaluacio", {}), ensure_ascii=False),
+            json.dumps(extra, ensure_ascii=False),
+        )
+
+    def _cas(self, id_cas: Any, problema: str, solucio: str, avaluacio: str, extra: str) -> Dict:
+        cas = {"id_cas": id_cas, "problema": json.loads(problema), "solucio": json.loads(solucio), "avaluacio": json.loads(avaluacio)}
+        cas.update(json.loads(extra or "{}"))
+        return cas
+
+    def _seleccionar(self, where: str = "", params: Iterable = ()) -> List[Tuple[int, Dict]]:
+        sql = f"SELECT rowid, id_cas, problema, solucio, avaluacio, extra FROM casos {where} ORDER BY rowid"
+        return [(fila[0], self._cas(*fila[1:])) for fila in self.con.execute(sql, tuple(params))]
+
+    # --- INTERFÍCIE DE MAGATZEM ---
+
+    def carregar_files(self) -> List[Tuple[int, Dict]]:
+        """(rowid, cas) de tots els casos en ordre d'inserció. La primera càrrega fixa el punt de sincronització."""
+        files = self._seleccionar()
+        if self._ultim_rowid is None:
+            self._ultim_rowid = files[-1][0] if files else 0
+        return files
+
+    def carregar(self) -> List[Dict]:
+        """Tots els casos en ordre d'inserció."""
+        return [cas for _, cas in self.carregar_files()]
+
+    def afegir(self, cas: Dict[str, Any]) -> int:
+        """
+        Insereix un cas i retorna el seu rowid. Si el cas no porta id_cas, l'assigna SQLite
+        dins la mateixa sentència (MAX + 1), de manera que dos processos no en poden repetir cap.
+        """
+        columnes = ("id_cas",) + tuple(COLUMNES_PROBLEMA) + ("problema", "solucio", "avaluacio", "extra")
+        fila, marcadors = self._fila(cas), ["?"] * len(columnes)
+        assignar_id = cas.get("id_cas") is None
+        if assignar_id:
+            fila, marcadors[0] = fila[1:], "(SELECT COALESCE(MAX(id_cas), 0) + 1 FROM casos)"
+        with self.con:
+            cur = self.con.execute(f"INSERT INTO casos ({', '.join(columnes)}) VALUES ({', '.join(marcadors)})", fila)
+            if assignar_id:
+                cas["id_cas"] = self.con.execute("SELECT id_cas FROM casos WHERE rowid = ?", (cur.lastrowid,)).fetchone()[0]
+        self._rowids_propis.add(cur.lastrowid)
+        return cur.lastrowid
+
+    def compactar(self) -> None:
+        """Sense efecte: SQLite ja persisteix cada inserció de forma incremental."""
+        return None
+
+    def importar(self, casos: Iterable[Dict]) -> None:
+        """Migració inicial (p.ex. des de base_de_casos.json)."""
+        for cas in casos:
+            self.afegir(cas)
+        self._rowids_propis.clear()
+
+    def casos_nous(self) -> List[Tuple[int, Dict]]:
+        """(rowid, cas) dels casos inserits per altres processos des de l'última sincronització."""
+        files = self._seleccionar("WHERE rowid > ?", (self._ultim_rowid or 0,))
+        if files:
+            self._ultim_rowid = files[-1][0]
+        nous = [(rowid, cas) for rowid, cas in files if rowid not in self._rowids_propis]
+        self._rowids_propis.difference_update(rowid for rowid, _ in files)
+        return nous
+
+    def _where_prefiltre(self, prefiltre: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        """Tradueix el prefiltre a una clàusula WHERE sobre les columnes indexades."""
+        clausules, params = [], []
+        for columna, valor in prefiltre.items():
+            tipus, arg = _condicio(columna, valor)
+            if tipus == "igual":
+                clausules.append(f"{columna} = ?")
+                params.append(arg)
+            elif tipus == "dins":
+                arg = sorted(arg)
+                clausules.append(f"{columna} IN ({', '.join('?' * len(arg))})" if arg else "0")
+                params.extend(arg)
+            else:
+                minim, maxim = arg
+                if minim is not None:
+                    clausules.append(f"{columna} >= ?")
+                    params.append(float(minim))
+                if maxim is not None:
+                    clausules.append(f"{columna} <= ?")
+                    params.append(float(maxim))
+                if minim is None and maxim is None:
+                    clausules.append(f"{columna} IS NOT NULL")
+        return ("WHERE " + " AND ".join(clausules)) if clausules else "", params
+
+    def filtrar(self, prefiltre: Dict[str, Any]) -> List[int]:
+        """
+        Aplica el prefiltre en SQL (sobre columnes indexades) i retorna només els rowids
+        dels supervivents: el Retriever ja té els casos indexats per rowid.
+        """
+        where, params = self._where_prefiltre(prefiltre)
+        return [fila[0] for fila in self.con.execute(f"SELECT rowid FROM casos {where} ORDER BY rowid", params)]
@@ -16,6 +16,8 @@ from knowledge_base import KnowledgeBase
 from gestor_feedback import GestorRevise, MemoriaGlobal
 from operador_ingredients import (
     FG_WRAPPER,
+    _vector_estil,
+    filtre_perfil,
     ingredients_incompatibles,
     substituir_ingredients_prohibits,
 )
@@ -633,37 +635,6 @@ def _trobar_plat_alternatiu(
     return None
 
 
-def _check_compatibilitat_local(ingredient_info: Dict[str, Any], perfil_usuari: Optional[Dict[str, Any]]) -> bool:
-    """Valida al·lèrgies/dieta contra metadades locals d'un ingredient."""
-    if not ingredient_info:
-        return False
-    if not perfil_usuari:
-        return True
-
-    alergies = {_normalize_item(a) for a in (perfil_usuari.get("alergies", []) or []) if a}
-    if alergies:
-        alergens_ing = {
-            _normalize_item(p)
-            for p in str(ingredient_info.get("allergens", "") or "").split("|")
-            if p
-        }
-        familia_ing = _normalize_item(str(ingredient_info.get("family", "") or ""))
-        if alergies.intersection(alergens_ing) or (familia_ing and familia_ing in alergies):
-            return False
-
-    dieta = _normalize_item(str(perfil_usuari.get("dieta", "") or ""))
-    if dieta:
-        dietes_ing = {
-            _normalize_item(p)
-            for p in str(ingredient_info.get("allowed_diets", "") or "").split("|")
-            if p
-        }
-        if dieta not in dietes_ing:
-            return False
-
-    return True
-
-
 def _try_add_preferred_touch(
     plats: List[Dict[str, Any]],
     preferits: List[str],
@@ -678,22 +649,25 @@ def _try_add_preferred_touch(
     best: Optional[Tuple[Dict[str, Any], str, float]] = None
     best_score = 0.0
     threshold = 0.35
+    filtre = filtre_perfil(kb, perfil_usuari, vetats, parelles_vetades)
+    # Plats que ja contenen una parella vetada: no hi afegim cap toc
+    plats_vetats = {id(p) for p in plats if _plat_te_parella_vetada(list(p.get("ingredients", []) or []), parelles_vetades)}
 
     for pref in preferits:
         pref_norm = _normalize_item(pref)
-        if not pref_norm or pref_norm in vetats:
+        if not pref_norm or filtre.vetat(pref_norm):
             continue
 
         info = kb.get_info_ingredient(pref_norm)
-        if not _check_compatibilitat_local(info, perfil_usuari):
+        if not filtre.compatible(info):
             continue
 
-        pref_name = (info.get("ingredient_name") or pref_norm).strip() if isinstance(info, dict) else pref_norm
+        pref_name = (info.get("ingredient_name") or pref_norm).strip() if info else pref_norm
         for plat in plats:
             ings = list(plat.get("ingredients", []) or [])
             if pref_norm in {_normalize_item(i) for i in ings}:
                 continue
-            if parelles_vetades and _plat_te_parella_vetada(ings + [pref_name], parelles_vetades):
+            if id(plat) in plats_vetats or filtre.parella_vetada(pref_name, ings):
                 continue
 
             vec_plat = _vector_mitja(ings)
@@ -862,10 +836,7 @@ def _vector_mitja(ingredients: List[str]) -> Optional[np.ndarray]:
 
 def _similitud_plat_estil(ingredients: List[str], estils_latents: Dict[str, Any], nom_estil: str) -> float:
     """Similitud cosinus entre el plat (mitjana) i el vector de l'estil latent."""
-    estil_data = estils_latents.get(nom_estil, {}) or {}
-    ings_estil = estil_data.get("ingredients", []) or []
-
-    vec_estil = FG_WRAPPER.compute_concept_vector(ings_estil)
+    vec_estil = _vector_estil(kb, nom_estil, {nom_estil: estils_latents.get(nom_estil, {}) or {}})
     vec_plat = _vector_mitja(ingredients)
     if vec_estil is None or vec_plat is None:
         return 0.0
@@ -1331,6 +1302,7 @@ def main():
         pass
 
     _print_banner("SISTEMA DE RECOMANACIÓ DE MENÚS RICO RICO 2.0")
+    FG_WRAPPER.prefetch()  # Els embeddings es carreguen mentre l'usuari respon
 
     COST_INGREDIENT_EXTRA = 3
     COST_TECNICA_ALTA = 10
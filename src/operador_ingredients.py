@@ -1,9 +1,10 @@
 import random
 import re
 import unicodedata
-from typing import List, Dict, Set, Any, Optional
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 import numpy as np
-from flavorgraph_embeddings import FlavorGraphWrapper
+from flavorgraph_embeddings import LazyFlavorGraphWrapper
 
 """
 OPERADOR D'ADAPTACIÓ D'INGREDIENTS (FASE REUSE)
@@ -18,7 +19,8 @@ Aquest mòdul gestiona dues estratègies d'adaptació:
 També gestiona la coherència global (evitar parelles prohibides detectades pel Feedback N3).
 """
 
-FG_WRAPPER = FlavorGraphWrapper()
+# Es carrega al primer ús (els camins que no usen embeddings no paguen la càrrega)
+FG_WRAPPER = LazyFlavorGraphWrapper()
 
 # ---------------------------------------------------------------------
 # FUNCIONS AUXILIARS DE GESTIÓ DE DADES I VECTORS
@@ -222,21 +224,56 @@ def _normalize_vector(vec: Optional[np.ndarray]) -> Optional[np.ndarray]:
     norm = np.linalg.norm(vec)
     return vec / norm if norm != 0 else None
 
-def _calcular_vector_context(ingredients: List[str], exclude_index: int = -1) -> Optional[np.ndarray]:
+class _ContextPlat:
     """
-    Calcula el vector mitjà de la resta d'ingredients (Context).
-    Clau per avaluar el 'Pairing': com de bé encaixa un ingredient amb els seus veïns.
+    Vectors de context leave-one-out d'un plat.
+    La suma dels vectors es calcula un sol cop (O(n·D)); el context de la posició i és
+    (suma - v_i) / (k - 1), i la suma s'actualitza en O(D) quan es substitueix o s'afegeix un ingredient.
     """
-    vectors = [
-        FG_WRAPPER.get_vector(ing) for i, ing in enumerate(ingredients)
-        if i != exclude_index and FG_WRAPPER.get_vector(ing) is not None
-    ]
-    return np.mean(vectors, axis=0) if vectors else None
 
-def _vector_promig_plat(ingredients: List[str]) -> Optional[np.ndarray]:
-    """Calcula el centroide del plat complet (per comparar amb l'Estil objectiu)."""
-    vectors = [v for ing in ingredients if (v := FG_WRAPPER.get_vector(ing)) is not None]
-    return _normalize_vector(np.mean(vectors, axis=0)) if vectors else None
+    def __init__(self, ingredients: List[str]):
+        self.vectors = [FG_WRAPPER.get_vector(ing) for ing in ingredients]
+        presents = [v for v in self.vectors if v is not None]
+        self.k = len(presents)
+        self.suma = np.sum(presents, axis=0, dtype=float) if presents else None
+
+    def context(self, exclude_index: int = -1) -> Optional[np.ndarray]:
+        """
+        Vector mitjà (context) de la resta d'ingredients amb vector: (suma - v_i) / (k - 1).
+        Amb exclude_index fora de rang és la mitjana de tot el plat; None si no queda cap vector.
+        """
+        v = self.vectors[exclude_index] if 0 <= exclude_index < len(self.vectors) else None
+        k = self.k - (v is not None)
+        if k <= 0:
+            return None
+        return (self.suma - v if v is not None else self.suma) / k
+
+    def substituir(self, i: int, ingredient: Optional[str]) -> None:
+        antic, nou = self.vectors[i], FG_WRAPPER.get_vector(ingredient) if ingredient else None
+        if antic is not None:
+            self.suma = self.suma - antic
+            self.k -= 1
+        self._sumar(nou)
+        self.vectors[i] = nou
+
+    def afegir(self, ingredient: str) -> None:
+        nou = FG_WRAPPER.get_vector(ingredient)
+        self._sumar(nou)
+        self.vectors.append(nou)
+
+    def _sumar(self, v: Optional[np.ndarray]) -> None:
+        if v is None:
+            return
+        self.suma = v.astype(float) if self.k == 0 or self.suma is None else self.suma + v
+        self.k += 1
+
+def _vector_estil(kb: Any, nom_estil: str, base_estils_latents: Dict) -> Optional[np.ndarray]:
+    """Centroide d'un estil latent: de la cache de la KB si les dades són les seves, sinó es calcula."""
+    ingredients = base_estils_latents.get(nom_estil, {}).get('ingredients', []) or []
+    estils_kb = getattr(kb, "estils_latents", None)
+    if hasattr(kb, "vector_estil_latent") and isinstance(estils_kb, dict) and ((estils_kb.get(nom_estil) or {}).get('ingredients', []) or []) == ingredients:
+        return kb.vector_estil_latent(nom_estil)
+    return FG_WRAPPER.compute_concept_vector(ingredients)
 
 def _check_compatibilitat(ingredient_info: Dict, perfil_usuari: Optional[Dict]) -> bool:
     """Verifica restriccions dures (Seguretat): al·lèrgies i dietes explícites."""
@@ -297,23 +334,201 @@ def _check_compatibilitat(ingredient_info: Dict, perfil_usuari: Optional[Dict])
 
     return True
 
-def _check_parelles_prohibides(candidat: str, context_ingredients: List[str], parelles_prohibides: Set[str]) -> bool:
+class MascaresCompatibilitat:
     """
-    Verifica si afegir 'candidat' genera una combinació prohibida (feedback aprenentatge).
-    Consulta el conjunt de regles negatives (Canal A/B).
+    Restriccions dures de _check_compatibilitat precompilades en màscares de bits (enters).
+    Cada ingredient del catàleg codifica un cop els seus al·lèrgens/família, les dietes que no
+    declara i els marcadors de risc (halal, vegà, vegetarià, fruits secs, cacauets); un perfil
+    es compila a una màscara prohibida i la compatibilitat és un sol AND.
     """
-    if not parelles_prohibides: return False
-    cand_norm = _normalize_text(candidat)
-    
-    for other in context_ingredients:
-        other_norm = _normalize_text(other)
-        if cand_norm == other_norm: continue 
-        
-        # Clau ordenada per garantir unicitat de la parella (A|B == B|A)
-        pair = sorted([cand_norm, other_norm])
-        if f"{pair[0]}|{pair[1]}" in parelles_prohibides:
-            return True
-    return False
+    HALAL_HARAM, NO_VEGA, NO_VEGETARIA, FRUITS_SECS, CACAUETS, TE_DIETES = (1 << i for i in range(6))
+
+    def __init__(self, kb: Any):
+        fitxes = [f for clau in kb.ingredients if (f := kb.get_info_ingredient(clau))]
+        # Vocabulari de bits: dietes declarades i etiquetes d'al·lèrgia (al·lèrgens + famílies)
+        self._bits: Dict[tuple, int] = {}
+        for info in fitxes:
+            for dieta in self._dietes(info):
+                self._bit(("dieta", dieta))
+        for info in fitxes:
+            for etiqueta in self._alergens(info) | {self._familia(info)} - {""}:
+                self._bit(("alergia", etiqueta))
+        self._dietes_conegudes = [d for (espai, d) in self._bits if espai == "dieta"]
+
+        self.noms = [info["ingredient_name"] for info in fitxes]
+        self._fitxes = dict(zip(self.noms, fitxes))
+        self._per_nom = {nom: self._codificar(info) for nom, info in zip(self.noms, fitxes)}
+
+        # Matriu (n_ingredients x paraules de 64 bits) per a la consulta vectoritzada
+        self._n_paraules = max(1, -(-(6 + len(self._bits)) // 64))
+        self._matriu = np.array([self._paraules(self._per_nom[nom]) for nom in self.noms], dtype=np.uint64).reshape(len(self.noms), self._n_paraules)
+
+    def _bit(self, clau: tuple) -> int:
+        if clau not in self._bits:
+            self._bits[clau] = 1 << (6 + len(self._bits))
+        return self._bits[clau]
+
+    def _paraules(self, mascara: int) -> List[int]:
+        return [(mascara >> (64 * w)) & 0xFFFFFFFFFFFFFFFF for w in range(self._n_paraules)]
+
+    @staticmethod
+    def _alergens(info: Dict) -> Set[str]:
+        return {
+            _normalize_text(p)
+            for p in str(info.get('allergens') or info.get('alergens') or '').split('|')
+            if p and not _is_empty_tag(p)
+        }
+
+    @staticmethod
+    def _familia(info: Dict) -> str:
+        return _normalize_text(info.get('family') or info.get('familia'))
+
+    @staticmethod
+    def _dietes(info: Dict) -> Set[str]:
+        dietes_raw = info.get('allowed_diets') or info.get('dietes_permeses') or info.get('dietes') or ''
+        return {_normalize_diet_tag(p) for p in str(dietes_raw).split('|') if p and not _is_empty_tag(p)}
+
+    def _codificar(self, info: Dict) -> int:
+        """Màscara d'un ingredient (mateixos criteris que _check_compatibilitat)."""
+        mascara = 0
+        if _is_halal_haram(info): mascara |= self.HALAL_HARAM
+        if _es_no_vega(info): mascara |= self.NO_VEGA
+        if _es_no_vegetaria(info): mascara |= self.NO_VEGETARIA
+
+        familia = self._familia(info)
+        cat = _normalize_category(info.get("macro_category") or info.get("categoria_macro"))
+        tokens = _tokens_from_text(" ".join([_ingredient_name_blob(info), familia, cat]))
+        if _allergy_tokens_match({"nuts"}, tokens, cat): mascara |= self.FRUITS_SECS
+        if _allergy_tokens_match({"peanuts"}, tokens, cat): mascara |= self.CACAUETS
+
+        for etiqueta in self._alergens(info) | {familia}:
+            mascara |= self._bits.get(("alergia", etiqueta), 0)
+
+        # Les dietes només restringeixen si l'ingredient en declara alguna
+        if dietes := self._dietes(info):
+            mascara |= self.TE_DIETES
+            for dieta in self._dietes_conegudes:
+                if dieta not in dietes:
+                    mascara |= self._bits[("dieta", dieta)]
+        return mascara
+
+    def mascara(self, info: Dict) -> Optional[int]:
+        """
+        Màscara precalculada si 'info' és la fitxa compartida del catàleg. Per a fitxes externes o
+        copies modificades retorna None: el vocabulari de bits no en cobreix les etiquetes.
+        """
+        nom = info.get("ingredient_name")
+        return self._per_nom[nom] if self._fitxes.get(nom) is info else None
+
+    def prohibida(self, perfil_usuari: Optional[Dict]) -> int:
+        """Compila les al·lèrgies i la dieta d'un perfil a la màscara de bits prohibits."""
+        if not perfil_usuari:
+            return 0
+        mascara = 0
+        for a in perfil_usuari.get('alergies', []) or []:
+            if a and not _is_empty_tag(a):
+                alergia = _normalize_text(a)
+                mascara |= self._bits.get(("alergia", alergia), 0)
+                if alergia == "nuts": mascara |= self.FRUITS_SECS
+                if alergia == "peanuts": mascara |= self.CACAUETS
+
+        dieta = _normalize_diet_tag(perfil_usuari.get('dieta'))
+        if dieta == "halal_friendly":
+            mascara |= self.HALAL_HARAM
+        elif dieta == "vegan":
+            mascara |= self.NO_VEGA
+        elif dieta == "vegetarian":
+            mascara |= self.NO_VEGETARIA
+        elif dieta:
+            # Dieta no declarada per cap ingredient: prohibeix tots els que en declaren alguna
+            mascara |= self._bits.get(("dieta", dieta), self.TE_DIETES)
+        return mascara
+
+    def compatible(self, info: Optional[Dict], prohibida: int, perfil_usuari: Optional[Dict] = None) -> bool:
+        """Equivalent a _check_compatibilitat amb el perfil ja compilat (fitxes externes: comprovació completa)."""
+        if not info:
+            return False
+        mascara = self.mascara(info)
+        if mascara is None:
+            return _check_compatibilitat(info, perfil_usuari)
+        return not (mascara & prohibida)
+
+    def permesos(self, perfil_usuari: Optional[Dict]) -> FrozenSet[str]:
+        """Conjunt d'ingredients del catàleg compatibles amb el perfil (una passada vectoritzada)."""
+        prohibida = np.array(self._paraules(self.prohibida(perfil_usuari)), dtype=np.uint64)
+        permes = ~np.any(self._matriu & prohibida, axis=1)
+        return frozenset(nom for nom, ok in zip(self.noms, permes) if ok)
+
+def _compatibilitat_compilada(kb: Any, perfil_usuari: Optional[Dict]) -> Callable[[Optional[Dict]], bool]:
+    """Predicat equivalent a _check_compatibilitat(info, perfil_usuari) amb el perfil precompilat."""
+    if not hasattr(kb, "mascares_compatibilitat"):
+        return lambda info: _check_compatibilitat(info, perfil_usuari)
+    mascares = kb.mascares_compatibilitat()
+    prohibida = mascares.prohibida(perfil_usuari)
+    return lambda info: mascares.compatible(info, prohibida, perfil_usuari)
+
+class FiltrePerfil:
+    """
+    Univers d'ingredients segurs d'una petició: al·lèrgies i dieta del perfil, ingredients vetats
+    i parelles vetades compilats un sol cop. S'obté amb filtre_perfil(), que el reaprofita per clau
+    entre operadors i plats.
+    """
+
+    def __init__(self, kb: Any, perfil_usuari: Optional[Dict] = None, vetats: Optional[Set[str]] = None,
+                 parelles_vetades: Optional[Set[str]] = None):
+        self.vetats = frozenset(_normalize_text(v) for v in (vetats or ()) if v)
+        self.compatible = _compatibilitat_compilada(kb, perfil_usuari)
+
+        # Noms del catàleg compatibles i no vetats (None si la KB no té màscares)
+        self.permesos: Optional[FrozenSet[str]] = None
+        if hasattr(kb, "mascares_compatibilitat"):
+            permesos = kb.mascares_compatibilitat().permesos(perfil_usuari)
+            self.permesos = frozenset(n for n in permesos if _normalize_text(n) not in self.vetats) if self.vetats else permesos
+
+        # Parelles 'a|b' (ordenades, com les genera el feedback) -> veïns vetats de cada ingredient
+        self._veins: Dict[str, Set[str]] = {}
+        for clau in parelles_vetades or ():
+            parts = str(clau).split("|")
+            if len(parts) == 2 and parts[0] < parts[1]:
+                a, b = _normalize_text(parts[0]), _normalize_text(parts[1])
+                self._veins.setdefault(a, set()).add(b)
+                self._veins.setdefault(b, set()).add(a)
+
+    def vetat(self, nom: str) -> bool:
+        return _normalize_text(nom) in self.vetats
+
+    def parella_vetada(self, candidat: str, context_ingredients: List[str]) -> bool:
+        """
+        True si afegir 'candidat' forma una parella vetada amb algun ingredient del context
+        (clau ordenada 'a|b', A|B == B|A), amb una consulta per veí en lloc de construir claus.
+        """
+        veins = self._veins.get(_normalize_text(candidat))
+        return bool(veins) and any(_normalize_text(other) in veins for other in context_ingredients)
+
+_FILTRES_PERFIL: "OrderedDict[tuple, FiltrePerfil]" = OrderedDict()
+MIDA_CACHE_FILTRES = 64
+
+def filtre_perfil(kb: Any, perfil_usuari: Optional[Dict] = None, vetats: Optional[Set[str]] = None,
+                  parelles_vetades: Optional[Set[str]] = None) -> FiltrePerfil:
+    """Retorna (i memoritza) el FiltrePerfil de la clau (al·lèrgies, dieta, vetats, parelles vetades)."""
+    perfil = perfil_usuari or {}
+    clau = (
+        id(kb),
+        frozenset(_normalize_text(a) for a in perfil.get('alergies', []) or [] if a and not _is_empty_tag(a)),
+        _normalize_diet_tag(perfil.get('dieta')),
+        frozenset(_normalize_text(v) for v in (vetats or ()) if v),
+        frozenset(parelles_vetades or ()),
+    )
+    filtre = _FILTRES_PERFIL.get(clau)
+    if filtre is not None:
+        _FILTRES_PERFIL.move_to_end(clau)
+        return filtre
+
+    filtre = FiltrePerfil(kb, perfil_usuari, vetats, parelles_vetades)
+    _FILTRES_PERFIL[clau] = filtre
+    if len(_FILTRES_PERFIL) > MIDA_CACHE_FILTRES:
+        _FILTRES_PERFIL.popitem(last=False)
+    return filtre
 
 def _build_perfil_context(perfil_base: Optional[Dict], info_prohibit: Dict) -> Dict:
     """Crea un perfil temporal afegint les restriccions de l'ingredient que eliminem (per seguretat)."""
@@ -334,10 +549,11 @@ def ingredients_incompatibles(ingredients: List[str], kb: Any, perfil_usuari: Op
     """Identifica quins ingredients del plat violen el perfil de l'usuari."""
     prohibits = set()
     if not perfil_usuari: return prohibits
+    filtre = filtre_perfil(kb, perfil_usuari)
     
     for ing in ingredients:
         if info := kb.get_info_ingredient(ing):
-            if not _check_compatibilitat(info, perfil_usuari):
+            if not filtre.compatible(info):
                 prohibits.add(ing)
         else:
             dieta = _normalize_diet_tag(perfil_usuari.get("dieta"))
@@ -777,14 +993,18 @@ def _condiment_random_mode(temperature: float, rng: random.Random) -> bool:
 
 
 
-def _get_candidats_per_categoria(categoria: str, kb: Any) -> List[str]:
+def _get_candidats_per_categoria(categoria: str, kb: Any, permesos: Optional[Set[str]] = None) -> List[str]:
+    """Candidats d'una categoria macro en ordre de catàleg (índex invertit de la KB si n'hi ha)."""
+    if hasattr(kb, "ingredients_per_categoria"):
+        candidats = kb.ingredients_per_categoria(categoria)
+        return kb.ordre_cataleg(candidats & permesos if permesos is not None else candidats)
     cat_norm = _normalize_category(categoria)
     candidats = []
     for info in kb.ingredients.values():
         if _normalize_category(info.get('macro_category') or info.get('categoria_macro')) != cat_norm:
             continue
         nom = info.get("ingredient_name") or info.get("nom_ingredient") or info.get("name")
-        if nom:
+        if nom and (permesos is None or nom in permesos):
             candidats.append(nom)
     return candidats
 
@@ -962,6 +1182,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
     preferits = list(preferits or [])
     used_norms = set(ingredients_usats or [])
 
+    ctx = _ContextPlat(nou_plat['ingredients'])
     for i, ing_nom in enumerate(nou_plat['ingredients']):
         ing_norm = _normalize_text(ing_nom)
         
@@ -969,6 +1190,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
             info_orig = kb.get_info_ingredient(ing_nom)
             if not info_orig:
                 perfil_context = perfil_usuari or {}
+                filtre = filtre_perfil(kb, perfil_context, parelles_vetades=parelles_prohibides)
                 substitut_pref = None
                 for pref in preferits:
                     info_pref = kb.get_info_ingredient(pref)
@@ -980,17 +1202,18 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
                         continue
                     if whitelist_norm and pref_norm not in whitelist_norm:
                         continue
-                    if parelles_prohibides and _check_parelles_prohibides(pref_name, nou_plat['ingredients'], parelles_prohibides):
+                    if parelles_prohibides and filtre.parella_vetada(pref_name, nou_plat['ingredients']):
                         continue
                     if es_postres and not _es_candidat_postres_segura(info_pref, pref_name):
                         continue
-                    if not _check_compatibilitat(info_pref, perfil_context):
+                    if not filtre.compatible(info_pref):
                         continue
                     substitut_pref = pref_name
                     break
 
                 if substitut_pref:
                     nou_plat['ingredients'][i] = substitut_pref
+                    ctx.substituir(i, substitut_pref)
                     log_canvis.append(
                         f"Substitució: {ing_nom} -> {substitut_pref} [Preferència d'usuari]"
                     )
@@ -1002,6 +1225,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
                         f"Eliminat: {ing_nom} (ingredient no reconegut i restringit)"
                     )
                     nou_plat['ingredients'][i] = None
+                    ctx.substituir(i, None)
                 continue 
             
             # Context i candidats potencials
@@ -1011,6 +1235,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
             
             cats_candidats = [_normalize_category(cat_macro)]
             cats_candidats.extend(_categoria_fallbacks(_normalize_category(cat_macro), perfil_usuari))
+            filtre = filtre_perfil(kb, perfil_context, parelles_vetades=parelles_prohibides)
             
             candidats_map = {}
             candidats_dup_map = {}
@@ -1021,12 +1246,12 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
 
             # Filtratge de candidats
             for cat in cats_candidats:
-                for cand_nom in _get_candidats_per_categoria(cat, kb):
+                for cand_nom in _get_candidats_per_categoria(cat, kb, filtre.permesos):
                     c_norm = _normalize_text(cand_nom)
                     
                     if c_norm == ing_norm or c_norm in prohibits_norm: continue
                     if whitelist_norm and c_norm not in whitelist_norm: continue
-                    if parelles_prohibides and _check_parelles_prohibides(cand_nom, context_ingredients, parelles_prohibides): continue
+                    if parelles_prohibides and filtre.parella_vetada(cand_nom, context_ingredients): continue
 
                     info_cand = kb.get_info_ingredient(cand_nom)
                     if not info_cand:
@@ -1035,7 +1260,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
                         continue
                     if not _es_substitucio_semanticament_coherent(info_orig, info_cand, ing_nom, cand_nom):
                         continue
-                    if _check_compatibilitat(info_cand, perfil_context) and _es_candidat_coherent(info_orig, info_cand, _normalize_text(cat_macro)):
+                    if filtre.compatible(info_cand) and _es_candidat_coherent(info_orig, info_cand, _normalize_text(cat_macro)):
                         if c_norm in context_norm:
                             if c_norm in used_norms:
                                 candidats_used_dup_map[c_norm] = cand_nom
@@ -1059,13 +1284,13 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
                 candidats_relax = []
                 candidats_relax_used = []
                 for cat in cats_candidats:
-                    for cand_nom in _get_candidats_per_categoria(cat, kb):
+                    for cand_nom in _get_candidats_per_categoria(cat, kb, filtre.permesos):
                         c_norm = _normalize_text(cand_nom)
                         if c_norm == ing_norm or c_norm in prohibits_norm:
                             continue
                         if whitelist_norm and c_norm not in whitelist_norm:
                             continue
-                        if parelles_prohibides and _check_parelles_prohibides(cand_nom, context_ingredients, parelles_prohibides):
+                        if parelles_prohibides and filtre.parella_vetada(cand_nom, context_ingredients):
                             continue
                         info_cand = kb.get_info_ingredient(cand_nom)
                         if not info_cand:
@@ -1074,7 +1299,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
                             continue
                         if not _es_substitucio_semanticament_coherent(info_orig, info_cand, ing_nom, cand_nom):
                             continue
-                        if _check_compatibilitat(info_cand, perfil_context):
+                        if filtre.compatible(info_cand):
                             if c_norm in used_norms:
                                 candidats_relax_used.append(cand_nom)
                             else:
@@ -1105,7 +1330,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
             justificacio = ""
 
             vec_orig = FG_WRAPPER.get_vector(ing_nom)
-            vec_context = _calcular_vector_context(context_ingredients)
+            vec_context = ctx.context(i)
             use_vectors = vec_orig is not None or vec_context is not None
 
             # Preferències d'usuari (prioritat si encaixa)
@@ -1126,13 +1351,13 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
                     continue
                 if whitelist_norm and pref_norm not in whitelist_norm:
                     continue
-                if parelles_prohibides and _check_parelles_prohibides(pref_name, context_ingredients, parelles_prohibides):
+                if parelles_prohibides and filtre.parella_vetada(pref_name, context_ingredients):
                     continue
                 if es_postres and not _es_candidat_postres_segura(info_pref, pref_name):
                     continue
                 if not _es_substitucio_semanticament_coherent(info_orig, info_pref, ing_nom, pref_name):
                     continue
-                if not _check_compatibilitat(info_pref, perfil_context):
+                if not filtre.compatible(info_pref):
                     continue
                 if not _es_candidat_coherent(info_orig, info_pref, _normalize_category(cat_macro)):
                     continue
@@ -1184,6 +1409,7 @@ def substituir_ingredients_prohibits(plat: Dict[str, Any], ingredients_prohibits
                     justificacio = "Aleatori"
 
             nou_plat['ingredients'][i] = millor_substitut
+            ctx.substituir(i, millor_substitut)
             log_canvis.append(f"Substitució: {ing_nom} -> {millor_substitut} [{justificacio}]")
             used_norms.add(_normalize_text(millor_substitut))
             if ingredients_usats is not None:
@@ -1206,11 +1432,11 @@ def _adaptar_latent_core(plat: Dict, nom_estil: str, kb: Any, base_estils_latent
     if not base_estils_latents: return plat
     
     # Configuració inicial de l'Estil
-    estil_data = base_estils_latents.get(nom_estil, {})
-    vector_estil = FG_WRAPPER.compute_concept_vector(estil_data.get('ingredients', []))
+    vector_estil = _vector_estil(kb, nom_estil, base_estils_latents)
     if vector_estil is None: return plat
 
     if ingredients_estil_usats is None: ingredients_estil_usats = set()
+    filtre = filtre_perfil(kb, perfil_usuari, parelles_vetades=parelles_prohibides)
 
     nou_plat = plat.copy()
     nou_plat['ingredients'] = list(plat['ingredients']) 
@@ -1223,16 +1449,26 @@ def _adaptar_latent_core(plat: Dict, nom_estil: str, kb: Any, base_estils_latent
     canvis_fets = 0
 
     # FASE A: SUBSTITUCIÓ (Prioritat: Transformació estructural)
-    # Busca substituir ingredients existents per opcions més properes a l'estil objectiu.    
+    # Busca substituir ingredients existents per opcions més properes a l'estil objectiu.
+    # Cerca creativa (temperatura alta) de tots els ingredients del plat en un sol lot:
+    # només depèn de l'ingredient original, no de les substitucions ja fetes.
+    sims_estil_orig = {
+        i: FG_WRAPPER.similarity_with_vector(ing, vector_estil) or 0.0
+        for i, ing in enumerate(nou_plat['ingredients']) if FG_WRAPPER.get_vector(ing) is not None
+    }
+    a_cercar = [i for i, sim in sims_estil_orig.items() if sim <= 0.85] # La resta ja són idonis
+    candidats_lot = FG_WRAPPER.get_creative_candidates_batch(
+        [nou_plat['ingredients'][i] for i in a_cercar], n=n_search, temperature=temperatura, style_vector=vector_estil
+    )
+    candidats_per_ing = dict(zip(a_cercar, candidats_lot))
+    ctx = _ContextPlat(nou_plat['ingredients'])
+    rols_compatibles: Dict[Tuple[str, str], bool] = {}
+
     for i, ing_original in enumerate(nou_plat['ingredients']):
+        if i not in candidats_per_ing: continue
         vec_orig = FG_WRAPPER.get_vector(ing_original)
-        if vec_orig is None: continue
-        
-        sim_style_orig = FG_WRAPPER.similarity_with_vector(ing_original, vector_estil) or 0.0
-        if sim_style_orig > 0.85: continue # L'ingredient ja és idoni
-
-        # Cerca creativa (temperatura alta)
-        candidats = FG_WRAPPER.get_creative_candidates(ing_original, n=n_search, temperature=temperatura, style_vector=vector_estil)
+        sim_style_orig = sims_estil_orig[i]
+        candidats = candidats_per_ing[i]
         
         info_orig = kb.get_info_ingredient(ing_original)
         if not info_orig:
@@ -1244,49 +1480,56 @@ def _adaptar_latent_core(plat: Dict, nom_estil: str, kb: Any, base_estils_latent
         
         # Pesos agressius: Prioritzem Estil (60%) sobre Pairing (35%) i Fidelitat Original (5%)
         W_STYLE, W_PAIRING, W_SELF = 0.60, 0.35, 0.05
-        vec_context = _calcular_vector_context(nou_plat['ingredients'], exclude_index=i)
-
-        for cand, _ in candidats:
-            cand_norm = _normalize_text(cand)
-            if cand_norm == _normalize_text(ing_original) or cand_norm in ingredients_estil_usats: continue
-
-            info_cand = kb.get_info_ingredient(cand)
-            if not info_cand: continue
-            
-            # Validacions de seguretat i ontològiques
-            context_noms = [nou_plat['ingredients'][k] for k in range(len(nou_plat['ingredients'])) if k != i]
-            if parelles_prohibides and _check_parelles_prohibides(cand, context_noms, parelles_prohibides): continue
-            if not _check_compatibilitat(info_cand, perfil_usuari): continue
-            
-            cat_cand = _normalize_category(info_cand.get("macro_category") or "unknown")
-            if es_postres:
-                if not _es_apte_postres(info_cand, intensitat, cand):
-                    continue
-                # Relaxacio per postres (permet canviar fruita per dolc si intensitat es alta)
-                if cat_orig == "fruit" and cat_cand not in {"fruit", "nuts"} and not (intensitat > 0.6 and cat_cand == "sweetener"):
-                    continue
-            else:
-                if not _check_role_compatibility(cat_orig, cat_cand): continue
-
-            # Càlcul de Puntuació Híbrida
-            sim_style = FG_WRAPPER.similarity_with_vector(cand, vector_estil) or 0.0
-            sim_self = FG_WRAPPER.similarity_with_vector(cand, vec_orig) or 0.0
-            
-            sim_pairing = 0.0
-            if vec_context is not None:
-                sim_pair_raw = FG_WRAPPER.similarity_with_vector(cand, vec_context)
-                if sim_pair_raw: sim_pairing = sim_pair_raw
-            
-            score = (W_STYLE * sim_style) + (W_PAIRING * sim_pairing) + (W_SELF * sim_self)
-            score_current = (W_STYLE * sim_style_orig) + (W_PAIRING * sim_pairing) + (W_SELF * 1.0)
-            
-            if score > score_current or (sim_style > sim_style_orig + 0.1):
-                if score > millor_score_hibrid:
-                    millor_score_hibrid = score
-                    millor_cand = cand
+        vec_context = ctx.context(i)
+        context_noms = [nou_plat['ingredients'][k] for k in range(len(nou_plat['ingredients'])) if k != i]
+        ing_orig_norm = _normalize_text(ing_original)
+
+        # Filtres simbòlics (seguretat, ontologia, postres) com a màscares booleanes sobre el pool
+        pool = [cand for cand, _ in candidats if kb.get_info_ingredient(cand)]
+        infos = [kb.get_info_ingredient(cand) for cand in pool]
+        cats = [_normalize_category(info.get("macro_category") or "unknown") for info in infos]
+        noms_norm = [_normalize_text(cand) for cand in pool]
+
+        mascara = np.array([n != ing_orig_norm and n not in ingredients_estil_usats for n in noms_norm], dtype=bool)
+        if filtre.permesos is not None:
+            mascara &= np.array([info["ingredient_name"] in filtre.permesos for info in infos], dtype=bool)
+        else:
+            mascara &= np.array([filtre.compatible(info) for info in infos], dtype=bool)
+        if parelles_prohibides:
+            mascara &= np.array([not filtre.parella_vetada(cand, context_noms) for cand in pool], dtype=bool)
+        if es_postres:
+            mascara &= np.array([_es_apte_postres(info, intensitat, cand) for info, cand in zip(infos, pool)], dtype=bool)
+            # Relaxacio per postres (permet canviar fruita per dolc si intensitat es alta)
+            if cat_orig == "fruit":
+                permeses = {"fruit", "nuts"} | ({"sweetener"} if intensitat > 0.6 else set())
+                mascara &= np.isin(np.array(cats, dtype=object), list(permeses))
+        else:
+            # Compatibilitat de rol per (categoria original, categoria candidata), calculada un cop
+            for cat in set(cats):
+                if (cat_orig, cat) not in rols_compatibles:
+                    rols_compatibles[(cat_orig, cat)] = _check_role_compatibility(cat_orig, cat)
+            mascara &= np.array([rols_compatibles[(cat_orig, cat)] for cat in cats], dtype=bool)
+        valids = [pool[k] for k in np.flatnonzero(mascara)]
+
+        if valids:
+            # Càlcul de Puntuació Híbrida: les tres similituds en un sol producte (C x D · D x 3)
+            sims = np.nan_to_num(FG_WRAPPER.similarity_matrix(valids, [vector_estil, vec_orig, vec_context]), nan=0.0)
+            sim_style, sim_self, sim_pairing = sims[:, 0], sims[:, 1], sims[:, 2]
+
+            scores = (W_STYLE * sim_style) + (W_PAIRING * sim_pairing) + (W_SELF * sim_self)
+            scores_current = (W_STYLE * sim_style_orig) + (W_PAIRING * sim_pairing) + (W_SELF * 1.0)
+            millora = (scores > scores_current) | (sim_style > sim_style_orig + 0.1)
+
+            # Primer màxim entre els que milloren (mateix desempat que el recorregut seqüencial)
+            scores = np.where(millora, scores, -np.inf)
+            j = int(np.argmax(scores))
+            if scores[j] > millor_score_hibrid:
+                millor_score_hibrid = float(scores[j])
+                millor_cand = valids[j]
 
         if millor_cand:
             nou_plat['ingredients'][i] = millor_cand
+            ctx.substituir(i, millor_cand)
             log.append(f"Estil {nom_estil}: Substituït {ing_original} per {millor_cand}")
             ingredients_estil_usats.add(_normalize_text(millor_cand))
             canvis_fets += 1
@@ -1294,7 +1537,7 @@ def _adaptar_latent_core(plat: Dict, nom_estil: str, kb: Any, base_estils_latent
     # FASE B: INSERCIÓ (Enriquiment)
     # Si el plat encara és lluny de l'estil, s'afegeixen ingredients representatius (tocs).
     sim_global = 0.0
-    if (vp := _vector_promig_plat(nou_plat['ingredients'])) is not None:
+    if (vp := _normalize_vector(ctx.context())) is not None:
         if (ve := _normalize_vector(vector_estil)) is not None: sim_global = float(np.dot(vp, ve))
     
     TARGET_SIM = 0.88 if es_postres else 0.82
@@ -1305,15 +1548,15 @@ def _adaptar_latent_core(plat: Dict, nom_estil: str, kb: Any, base_estils_latent
         
         millor_toc = None
         millor_val = -1.0
-        vec_context_final = _calcular_vector_context(nou_plat['ingredients']) 
+        vec_context_final = ctx.context()
 
         # Cerca del millor complement
         for cand, score_style in representants:
             if _normalize_text(cand) in ingredients_estil_usats: continue
 
             if info_cand := kb.get_info_ingredient(cand):
-                if parelles_prohibides and _check_parelles_prohibides(cand, nou_plat['ingredients'], parelles_prohibides): continue
-                if not _check_compatibilitat(info_cand, perfil_usuari): continue
+                if parelles_prohibides and filtre.parella_vetada(cand, nou_plat['ingredients']): continue
+                if not filtre.compatible(info_cand): continue
                 
                 if es_postres and not _es_apte_postres(info_cand, intensitat, cand):
                     continue
@@ -1333,6 +1576,7 @@ def _adaptar_latent_core(plat: Dict, nom_estil: str, kb: Any, base_estils_latent
 
         if millor_toc:
             nou_plat['ingredients'].append(millor_toc)
+            ctx.afegir(millor_toc)
             log.append(f"Estil {nom_estil}: Afegit {millor_toc} com a toc final.")
             ingredients_estil_usats.add(_normalize_text(millor_toc))
 
@@ -1345,11 +1589,11 @@ def _adaptar_latent_core(plat: Dict, nom_estil: str, kb: Any, base_estils_latent
         ]
         
         # Pre-càlcul de pairing per candidats simbòlics
-        vec_ctx = _calcular_vector_context(nou_plat.get("ingredients", []))
+        vec_ctx = ctx.context()
         puntuats = []
         for cand in candidats_estil:
             if info := kb.get_info_ingredient(cand):
-                if not _check_compatibilitat(info, perfil_usuari): continue
+                if not filtre.compatible(info): continue
                 cat = _normalize_category(info.get("macro_category") or "unknown")
                 if es_postres and not _es_apte_postres(info, intensitat, cand):
                     continue